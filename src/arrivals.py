@@ -0,0 +1,113 @@
+import numpy as np
+
+def arrival_rate(params, times):
+    """
+    Returns the arrival rate (patients per minute) at each of the given times
+
+    Params:
+    -------
+    params = simulation parameters, see Params.arrival_profile
+    times = numpy array of simulation times in minutes
+    """
+    base_rate = 1.0 / params.mean_interarrival
+    if params.arrival_profile is None:
+        return np.full(len(times), base_rate)
+    profile = np.asarray(params.arrival_profile, dtype=float)
+    hours = (params.start_hour + (times // 60).astype(np.int64)) % len(profile)
+    return base_rate * profile[hours]
+
+def peak_rate(params):
+    """
+    Returns the highest arrival rate (patients per minute) of the schedule
+    """
+    if params.arrival_profile is None:
+        return 1.0 / params.mean_interarrival
+    return max(params.arrival_profile) / params.mean_interarrival
+
+def expected_arrivals(params, start, horizon, include_start=True):
+    """
+    Returns the expected number of arrivals in [start, horizon), see arrival_chunks
+
+    Params:
+    -------
+    params = simulation parameters
+    start = start of the schedule
+    horizon = end of the schedule
+    include_start = whether a patient arrives at start, thinned like any other candidate
+                    with a profile so it only counts rate(start) / peak rate
+    """
+    if params.arrival_profile is None:
+        expected = (horizon - start) / params.mean_interarrival
+    else:
+        # Integrate the rate, constant within every hour
+        hours = np.arange(start // 60, -(-horizon // 60)) * 60.0
+        overlap = np.minimum(hours + 60, horizon) - np.maximum(hours, start)
+        expected = float(np.sum(arrival_rate(params, hours) * overlap))
+    if include_start and start < horizon:
+        expected += float(arrival_rate(params, np.array([start]))[0]) / peak_rate(params)
+    return expected
+
+def arrival_chunks(params, rng, thinning_rng, horizon, start=0.0, include_start=True, chunk_size=None):
+    """
+    Yields the sorted arrival times in [start, horizon) as consecutive numpy
+    arrays, generated in bulk.
+
+    A constant rate is a cumulative sum of exponential gaps. With an hourly
+    Params.arrival_profile, candidates are generated at the peak rate and each
+    is kept with probability rate(t) / peak rate (thinning). Chunks draw the
+    streams in the same order, so the arrival times do not depend on chunk_size.
+
+    Params:
+    -------
+    params = simulation parameters
+    rng = numpy generator of the exponential gaps
+    thinning_rng = numpy generator of the thinning uniforms
+    horizon = end of the schedule
+    start = start of the schedule
+    include_start = whether a patient arrives at start, otherwise the first
+                    arrival is one gap later
+    chunk_size = maximum number of gaps drawn per chunk, None draws the expected
+                 number of arrivals at once
+    """
+    peak = peak_rate(params)
+
+    # Draw gaps in blocks sized from the expected number of arrivals
+    block_size = int((horizon - start) * peak * 1.1) + 16
+    if chunk_size is not None:
+        block_size = min(block_size, chunk_size)
+    pending = np.array([start]) if include_start else None
+    last = start
+    while last < horizon or pending is not None:
+        if last < horizon:
+            block = np.cumsum(np.concatenate(([last], rng.exponential(1.0 / peak, block_size))))[1:]
+            last = block[-1]
+            times = block if pending is None else np.concatenate((pending, block))
+        else:
+            times = pending
+        pending = None
+        times = times[times < horizon]
+        if params.arrival_profile is not None:
+            keep = thinning_rng.random(len(times)) * peak < arrival_rate(params, times)
+            times = times[keep]
+        if len(times):
+            yield times
+
+def arrival_schedule(params, rng, thinning_rng, horizon, start=0.0, include_start=True):
+    """
+    Returns the sorted arrival times in [start, horizon) as one numpy array,
+    see arrival_chunks
+    """
+    chunks = list(arrival_chunks(params, rng, thinning_rng, horizon, start, include_start))
+    return np.concatenate(chunks) if chunks else np.empty(0)
+
+if __name__ == "__main__":
+    # The arrivals control variate, count / expected - 1, must have a mean of zero
+    from parameters import Params
+    runs = 20000
+    profiles = {'constant': None, 'day': [0.5] * 6 + [1.5] * 12 + [0.5] * 6, 'quiet start': [0.1] + [1.9] * 23}
+    for name, profile in profiles.items():
+        params = Params(arrival_profile=profile)
+        rng = np.random.default_rng(params.random_seed)
+        expected = expected_arrivals(params, 0, 60)
+        deviations = np.array([len(arrival_schedule(params, rng, rng, 60)) / expected - 1 for _ in range(runs)])
+        print(f"{name}: mean deviation {deviations.mean():+.4f} +/- {1.96 * deviations.std() / runs ** 0.5:.4f}")
@@ -0,0 +1,150 @@
+"""
+Benchmark of simulation throughput and scaling.
+
+Every case (arrival rate, run count, worker count, tracing, engine) runs in a freshly
+spawned process so its peak RSS is not inflated by earlier cases. Results are
+written as JSON so runs on different commits can be compared:
+
+    python benchmark.py --output bench.json
+    python benchmark.py --output new.json --compare bench.json
+    python benchmark.py --engine simpy kernel
+"""
+import argparse
+import itertools
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import subprocess
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import simpy
+from parameters import Params
+from main import map_replications, run_replication
+from tracing import TraceConfig, QUEUE
+
+class CountingEnvironment(simpy.Environment):
+    """
+    SimPy environment counting the events it processes
+    """
+    def __init__(self, initial_time=0):
+        super().__init__(initial_time)
+        self.events = 0
+
+    def step(self):
+        self.events += 1
+        super().step()
+
+def timed_replication(params, run, trace=None):
+    """
+    Runs one replication and returns its patients, events and wall-clock seconds.
+    Events are only counted by the SimPy engine.
+    """
+    env = CountingEnvironment() if params.engine == 'simpy' else None
+    start = time.perf_counter()
+    dataset = run_replication(params, run, trace, env)
+    seconds = time.perf_counter() - start
+    return {'patients': dataset.size, 'events': env.events if env is not None else None, 'seconds': seconds}
+
+def peak_rss_mb(who):
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS
+    scale = 1024 * 1024 if platform.system() == 'Darwin' else 1024
+    return resource.getrusage(who).ru_maxrss / scale
+
+def run_case(mean_interarrival, runs, workers, trace, engine='simpy'):
+    """
+    Runs one benchmark case and returns its measurements
+    """
+    params = Params(mean_interarrival=mean_interarrival, number_of_runs=runs, engine=engine)
+    with tempfile.TemporaryDirectory() as directory:
+        trace_config = TraceConfig(directory, QUEUE) if trace else None
+        start = time.perf_counter()
+        results = list(map_replications(((params, run) for run in range(runs)), workers, trace_config,
+                                        timed_replication))
+        wall = time.perf_counter() - start
+
+    latencies = np.array([result['seconds'] for result in results]) * 1000
+    patients = sum(result['patients'] for result in results)
+    events = sum(result['events'] for result in results) if engine == 'simpy' else None
+    return {
+        'mean_interarrival': mean_interarrival,
+        'runs': runs,
+        'workers': workers,
+        'trace': trace,
+        'engine': engine,
+        'wall_seconds': wall,
+        'patients': patients,
+        'events': events,
+        'patients_per_second': patients / wall,
+        'events_per_second': events / wall if events is not None else None,
+        'replication_latency_ms': {'mean': float(latencies.mean()), 'p50': float(np.percentile(latencies, 50)),
+                                   'p95': float(np.percentile(latencies, 95))},
+        'peak_rss_mb': peak_rss_mb(resource.RUSAGE_SELF),
+        'peak_worker_rss_mb': peak_rss_mb(resource.RUSAGE_CHILDREN),
+    }
+
+def environment():
+    """
+    Returns the metadata identifying where and on what commit the benchmark ran
+    """
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        commit = None
+    return {'commit': commit, 'python': platform.python_version(), 'simpy': simpy.__version__,
+            'cpu_count': os.cpu_count(), 'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S')}
+
+def run_benchmark(interarrivals, run_counts, worker_counts, traces, engines=('simpy',)):
+    """
+    Runs every combination of the given settings, each in a fresh process
+    """
+    cases = []
+    context = multiprocessing.get_context('spawn')
+    for case in itertools.product(interarrivals, run_counts, worker_counts, traces, engines):
+        with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+            result = executor.submit(run_case, *case).result()
+        events = f"{result['events_per_second']:,.0f} events/s, " if result['events_per_second'] is not None else ""
+        print(f"interarrival={case[0]} runs={case[1]} workers={case[2]} trace={case[3]} engine={case[4]}: "
+              f"{events}{result['patients_per_second']:,.0f} patients/s, "
+              f"{result['replication_latency_ms']['mean']:.1f} ms/replication, {result['peak_rss_mb']:.0f} MB")
+        cases.append(result)
+    return {'environment': environment(), 'cases': cases}
+
+def compare(current, baseline):
+    """
+    Print the throughput ratio of every case found in both benchmark results,
+    in patients/s since the kernel engine does not count events
+    """
+    key = lambda case: (case['mean_interarrival'], case['runs'], case['workers'], case['trace'],
+                        case.get('engine', 'simpy'))
+    previous = {key(case): case for case in baseline['cases']}
+    print(f"Compared with {baseline['environment']['commit']}")
+    for case in current['cases']:
+        if key(case) in previous:
+            ratio = case['patients_per_second'] / previous[key(case)]['patients_per_second']
+            print(f"interarrival={case['mean_interarrival']} runs={case['runs']} workers={case['workers']} "
+                  f"trace={case['trace']} engine={key(case)[4]}: {ratio:.2f}x patients/s")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--interarrival', type=float, nargs='+', default=[10, 5, 2], help="mean_interarrival values")
+    parser.add_argument('--runs', type=int, nargs='+', default=[20, 100], help="number of runs per case")
+    parser.add_argument('--workers', type=int, nargs='+', default=sorted({1, os.cpu_count()}), help="worker counts")
+    parser.add_argument('--trace', choices=['off', 'on', 'both'], default='both', help="tracing settings to run")
+    parser.add_argument('--engine', nargs='+', choices=['simpy', 'kernel'], default=['simpy'],
+                        help="simulation engines to run")
+    parser.add_argument('--output', default='benchmark.json', help="JSON file receiving the results")
+    parser.add_argument('--compare', help="previous benchmark JSON to compare against")
+    args = parser.parse_args()
+
+    traces = {'off': [False], 'on': [True], 'both': [False, True]}[args.trace]
+    results = run_benchmark(args.interarrival, args.runs, args.workers, traces, args.engine)
+    with open(args.output, 'w') as file:
+        json.dump(results, file, indent=2)
+    if args.compare:
+        with open(args.compare) as file:
+            compare(results, json.load(file))
@@ -0,0 +1,150 @@
+"""
+Run named scenarios from JSON or TOML files of Params overrides.
+
+A scenario file holds optional base overrides shared by its scenarios and a
+table of scenarios, each a set of overrides:
+
+    {"base": {"sim_duration": 1440},
+     "scenarios": {"10min": {}, "9min": {"mean_interarrival": 9}}}
+
+or in TOML:
+
+    [base]
+    sim_duration = 1440
+
+    [scenarios.10min]
+
+    [scenarios.9min]
+    mean_interarrival = 9
+
+Examples:
+
+    python cli.py scenarios/default.json
+    python cli.py scenarios/daily_profile.toml --runs 50 --workers 4 --output parquet --output-dir results
+    python cli.py scenarios/default.json --scenario simulated_ED_data_9min --seed 7 --engine kernel
+    python cli.py scenarios/default.json --check
+    python cli.py scenarios/default.json --runs 20 --common-random-numbers --antithetic --compare
+"""
+import argparse
+import json
+import os
+import sys
+from parameters import Params, check_overrides
+
+# Keys of a scenario file
+FILE_KEYS = {'base', 'scenarios'}
+def load_toml(path):
+    """
+    Returns the content of a TOML file, with tomllib (Python 3.11+) or the tomli package
+    """
+    try:
+        import tomllib
+    except ImportError:
+        try:
+            import tomli as tomllib
+        except ImportError:
+            raise ImportError(f"Reading {path} requires Python 3.11 or `pip install tomli`, or use a JSON file")
+    with open(path, 'rb') as file:
+        return tomllib.load(file)
+
+def load_scenarios(path):
+    """
+    Returns the scenarios of a file as a dict of name to Params overrides, the
+    base overrides of the file applied
+
+    Params:
+    -------
+    path = .json or .toml scenario file
+    """
+    if path.endswith('.toml'):
+        content = load_toml(path)
+    else:
+        with open(path) as file:
+            content = json.load(file)
+    if not isinstance(content, dict) or 'scenarios' not in content or set(content) - FILE_KEYS:
+        raise ValueError(f"{path}: expected a 'scenarios' table and optional 'base' overrides")
+    base = content.get('base', {})
+    scenarios = {}
+    for name, overrides in content['scenarios'].items():
+        overrides = {**base, **overrides}
+        try:
+            check_overrides(overrides)
+        except ValueError as error:
+            raise ValueError(f"{path}: scenario {name}: {error}")
+        scenarios[name] = overrides
+    return scenarios
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('files', nargs='+', help="JSON or TOML scenario files")
+    parser.add_argument('--scenario', action='append', help="only run this scenario, can be repeated")
+    parser.add_argument('--runs', type=int, help="number of replications of every scenario")
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help="number of worker processes")
+    parser.add_argument('--seed', type=int, help="base random seed of every scenario")
+    parser.add_argument('--output', choices=['csv', 'parquet', 'feather', 'none'], default='csv',
+                        help="output format of every scenario, see writers.open_writer")
+    parser.add_argument('--output-dir', default='data', help="directory the scenario outputs are written to")
+    parser.add_argument('--engine', choices=['simpy', 'kernel'], help="simulation engine")
+    parser.add_argument('--common-random-numbers', action='store_true',
+                        help="draw the service times of every patient on arrival, see Params.common_random_numbers")
+    parser.add_argument('--antithetic', action='store_true', help="run antithetic pairs of runs, see Params.antithetic")
+    parser.add_argument('--compare', action='store_true',
+                        help="print the paired difference of every scenario from the first one, with control variates")
+    parser.add_argument('--cache-dir', default='data/cache', help="replication cache directory")
+    parser.add_argument('--no-cache', action='store_true', help="simulate every replication again")
+    parser.add_argument('--check', action='store_true',
+                        help="validate the scenarios and print their analytical screen without simulating")
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = parse_args(argv)
+    scenarios = {}
+    try:
+        for path in args.files:
+            for name, overrides in load_scenarios(path).items():
+                if name in scenarios:
+                    raise ValueError(f"{path}: scenario {name} is defined twice")
+                scenarios[name] = overrides
+    except (OSError, ValueError, ImportError) as error:
+        sys.exit(f"error: {error}")
+    if args.scenario:
+        unknown = set(args.scenario) - set(scenarios)
+        if unknown:
+            sys.exit(f"error: unknown scenarios {sorted(unknown)}, expected some of {list(scenarios)}")
+        scenarios = {name: scenarios[name] for name in args.scenario}
+
+    # Command line options override every scenario
+    options = {'number_of_runs': args.runs, 'random_seed': args.seed, 'engine': args.engine}
+    options = {name: value for name, value in options.items() if value is not None}
+    if args.common_random_numbers:
+        options['common_random_numbers'] = True
+    if args.antithetic:
+        options['antithetic'] = True
+    scenarios = {name: {**overrides, **options} for name, overrides in scenarios.items()}
+
+    if args.check:
+        from screening import screen
+        for name, overrides in scenarios.items():
+            result = screen(Params(**overrides))
+            waits = ', '.join(f"{kpi} {value:.1f}" for kpi, value in result['kpis'].items())
+            print(f"{name}: {'stable' if result['stable'] else 'UNSTABLE'}, estimated {waits}")
+        return
+
+    from sweep import run_sweep
+    from estimators import WAIT_KPIS, KPI_CONTROLS, compare
+    summaries = run_sweep(scenarios, workers=args.workers, cache_dir=None if args.no_cache else args.cache_dir,
+                          output=None if args.output == 'none' else args.output, directory=args.output_dir)
+    for name, summary in summaries.items():
+        waits = ', '.join(f"{kpi} {summary.means[kpi].mean:.1f} +/- {summary.half_width(kpi):.1f}"
+                          for kpi in WAIT_KPIS)
+        print(f"{name}: {summary.runs} runs, mean {waits}")
+    if args.compare:
+        names = list(summaries)
+        for name in names[1:]:
+            comparison = compare(summaries[names[0]], summaries[name], controls=KPI_CONTROLS)
+            deltas = ', '.join(f"{kpi} {delta['difference']:+.2f} +/- {delta['half_width']:.2f}"
+                               for kpi, delta in comparison.items())
+            print(f"{name} - {names[0]}: {deltas}")
+
+if __name__ == "__main__":
+    main()
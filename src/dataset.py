@@ -1,22 +1,235 @@
-import pandas as pd
-import plotly.figure_factory as ff
+import math
+import numpy as np
+
+"""
+Output schema, one typed column per patient field
+"""
+COLUMNS = {
+    'p_id': np.int64,
+    'arrival_time': np.float64,
+    'priority': np.int8,
+    'triage_outcome': np.int8,
+    'lab_outcome': np.int8,
+    'bed_outcome': np.bool_,
+    'triage_wait_time': np.float64,
+    'finished_triage_time': np.float64,
+    'consultation_wait_time': np.float64,
+    'finished_consult_time': np.float64,
+    'lab_wait_time': np.float64,
+    'finished_lab_time': np.float64,
+    'bed_wait_time': np.float64,
+    'finished_bed_time': np.float64,
+    'run': np.int32,
+}
+# Outcome columns hold the entities.TriageOutcome / LabOutcome codes, labelled as
+CATEGORIES = {
+    'triage_outcome': ['main', 'fast'],
+    'lab_outcome': ['no lab', 'lab'],
+}
+# Timing fields, NaN when the patient skipped the stage
+TIMINGS = [name for name, dtype in COLUMNS.items() if dtype is np.float64 and name != 'arrival_time']
+# Columns whose totals and samples are kept for records flushed to a sink
+FLOATS = [name for name, dtype in COLUMNS.items() if dtype is np.float64]
 
 class Dataset:
-    def __init__(self, params):
-        self.patient_list = []
+    def __init__(self, params, run=0, capacity=256, sink=None, batch_size=4096, sample_size=4096):
+        """
+        Params:
+        -------
+        params = simulation parameters of the run
+        run = run id written to every record
+        capacity = number of records preallocated, columns double when full
+        sink = optional writer, records are then flushed to it every batch_size
+               patients so memory does not grow with the horizon
+        batch_size = number of records held before flushing them to the sink
+        sample_size = maximum number of flushed records whose float columns are
+                      kept, evenly spaced, for quantile estimates
+        """
         self.params = params
+        self.run = run
+        self.size = 0
+        if sink is not None:
+            capacity = min(capacity, batch_size)
+        self.columns = {name: np.empty(capacity, dtype=dtype) for name, dtype in COLUMNS.items()}
+        self.sink = sink
+        self.batch_size = batch_size
+        # Records already flushed, with the sum and count of the non-NaN values of every float
+        # column and a sample of every stride-th flushed record, in the order patients left
+        self.flushed = 0
+        self.totals = {name: [0.0, 0] for name in FLOATS}
+        self.sample = {name: [] for name in FLOATS}
+        self.sample_size = sample_size
+        self.stride = 1
+        # Time-weighted resource statistics, one row per run and stage
+        self.resources = []
+        # Downsampled (run, stage, time, busy, queue) samples, empty unless Params.monitor_interval is set
+        self.series = []
+        # Control variates of every run, see RandomStreams.controls
+        self.controls = []
 
-    def get_patients_df(self):
-        patient_dict_list = []
-        for patient in self.patient_list:
-            patient_dict = {}
-            for var_name, var_value in vars(patient).items():
-                if var_name != "params":
-                    patient_dict[var_name] = var_value
-            patient_dict_list.append(patient_dict)
-            df = pd.DataFrame(patient_dict_list)
-            df = df.sort_values(by='p_id')
-        return df
+    @classmethod
+    def from_columns(cls, params, run, columns):
+        """
+        Returns a dataset holding already collected columns, e.g. a cached run
+        """
+        dataset = cls(params, run, capacity=0)
+        dataset.columns = {name: np.asarray(columns[name], dtype=dtype) for name, dtype in COLUMNS.items()}
+        dataset.size = len(dataset.columns['p_id'])
+        return dataset
+
+    def reserve(self, capacity):
+        """
+        Grow every column to hold at least capacity records
+        """
+        current = len(self.columns['p_id'])
+        if capacity <= current:
+            return
+        capacity = max(capacity, 2 * current)
+        for name, column in self.columns.items():
+            grown = np.empty(capacity, dtype=column.dtype)
+            grown[:self.size] = column[:self.size]
+            self.columns[name] = grown
+
+    def add_patient(self, patient):
+        """
+        Append the record of a patient that left the ED
+        """
+        i = self.size
+        if i == len(self.columns['p_id']):
+            self.reserve(i + 1)
+        columns = self.columns
+        columns['p_id'][i] = patient.p_id
+        columns['arrival_time'][i] = patient.arrival_time
+        columns['priority'][i] = patient.priority
+        columns['triage_outcome'][i] = patient.triage_outcome
+        columns['lab_outcome'][i] = patient.lab_outcome
+        columns['bed_outcome'][i] = patient.bed_outcome
+        for name in TIMINGS:
+            columns[name][i] = getattr(patient, name)
+        columns['run'][i] = self.run
+        self.size = i + 1
+        if self.sink is not None and self.size >= self.batch_size:
+            self.flush()
+
+    def add_resource(self, stage, summary, series=()):
+        """
+        Add the monitored statistics of a stage's resource
+
+        Params:
+        -------
+        stage = name of the stage
+        summary = dict of statistics, see Monitored.summary
+        series = (time, busy, queue) samples of the resource
+        """
+        self.resources.append({'run': self.run, 'stage': stage, **summary})
+        self.series.extend((self.run, stage, time, busy, queue) for time, busy, queue in series)
+
+    def add_controls(self, controls):
+        """
+        Add the control variates of the run, a dict of name to value with a known mean of zero
+        """
+        self.controls.append({'run': self.run, **controls})
+
+    def extend(self, other):
+        """
+        Append every record of another dataset, e.g. a finished run
+        """
+        self.reserve(self.size + other.size)
+        for name, column in self.columns.items():
+            column[self.size:self.size + other.size] = other.columns[name][:other.size]
+        self.size += other.size
+        self.resources.extend(other.resources)
+        self.series.extend(other.series)
+        self.controls.extend(other.controls)
 
+    def flush(self, final=False):
+        """
+        Write the records held to the sink, sorted by patient id, and drop them
+
+        Params:
+        -------
+        final = also write the resource statistics and time series, at the end of the run
+        """
+        size = self.size
+        columns = {name: column[:size] for name, column in self.columns.items()}
+        first = -self.flushed % self.stride
+        for name in FLOATS:
+            values = columns[name]
+            valid = values[~np.isnan(values)]
+            self.totals[name][0] += float(valid.sum())
+            self.totals[name][1] += len(valid)
+            self.sample[name].append(values[first::self.stride].copy())
+        self.flushed += size
+        # Halve the sample by doubling the stride, records kept stay evenly spaced from the first one
+        while sum(len(part) for part in self.sample[FLOATS[0]]) > self.sample_size:
+            self.stride *= 2
+            for name in FLOATS:
+                self.sample[name] = [np.concatenate(self.sample[name])[::2]]
+
+        order = np.argsort(columns['p_id'], kind='stable')
+        batch = Dataset.from_columns(self.params, self.run, {name: column[order] for name, column in columns.items()})
+        if final:
+            batch.resources = self.resources
+            batch.series = self.series
+        if size or final:
+            self.sink.write(batch)
+        self.size = 0
+
+    def finalise(self):
+        """
+        Trim the columns to the records held and sort them by patient id. With a
+        sink, flush the remaining records and detach from it instead
+        """
+        if self.sink is not None:
+            self.flush(final=True)
+            self.sink = None
+            self.columns = {name: column[:0] for name, column in self.columns.items()}
+            return
+        order = np.argsort(self.columns['p_id'][:self.size], kind='stable')
+        self.columns = {name: column[order] for name, column in self.columns.items()}
+
+    def values(self, name):
+        """
+        Returns the non-NaN values of a float column over the records held, or
+        over the sample of the run once records have been flushed
+        """
+        if self.flushed:
+            values = np.concatenate(self.sample[name])
+        else:
+            values = self.columns[name][:self.size]
+        return values[~np.isnan(values)]
+
+    def mean(self, name):
+        """
+        Returns the mean of the non-NaN values of a float column over every
+        record of the run, flushed or held
+        """
+        values = self.columns[name][:self.size]
+        values = values[~np.isnan(values)]
+        if not self.flushed:
+            return float(values.mean()) if len(values) else math.nan
+        total, count = self.totals[name]
+        count += len(values)
+        return (total + float(values.sum())) / count if count else math.nan
+
+    def get_patients_df(self):
+        """
+        Returns a DataFrame viewing the columns without copying them
+        """
+        # pandas is only imported by the paths building DataFrames
+        import pandas as pd
+        data = {}
+        for name, column in self.columns.items():
+            column = column[:self.size]
+            if name in CATEGORIES:
+                column = pd.Categorical.from_codes(column, categories=CATEGORIES[name])
+            data[name] = column
+        return pd.DataFrame(data, copy=False)
 
+    def get_resources_df(self):
+        import pandas as pd
+        return pd.DataFrame(self.resources)
 
+    def get_series_df(self):
+        import pandas as pd
+        return pd.DataFrame(self.series, columns=['run', 'stage', 'time', 'busy', 'queue'])
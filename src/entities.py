@@ -1,37 +1,84 @@
-import random
+from enum import IntEnum
+import math
 from utils import *
 from parameters import *
 
+class Priority(IntEnum):
+    """
+    Triage priority, lower values are seen first
+    """
+    IMMEDIATE = 1
+    VERY_URGENT = 2
+    URGENT = 3
+    STANDARD = 4
+    NON_URGENT = 5
+
+class TriageOutcome(IntEnum):
+    MAIN = 0
+    FAST = 1
+
+class LabOutcome(IntEnum):
+    NO_LAB = 0
+    LAB = 1
+
 class Patient:
-    def __init__(self, p_id, arrival_time) -> None:
+    # Fixed schema, every timing field exists up front and stays NaN if the stage is skipped
+    __slots__ = ('p_id', 'arrival_time', 'params', 'priority', 'triage_outcome', 'lab_outcome', 'bed_outcome',
+                 'triage_wait_time', 'finished_triage_time', 'consultation_wait_time', 'finished_consult_time',
+                 'lab_wait_time', 'finished_lab_time', 'bed_wait_time', 'finished_bed_time', 'demands')
+
+    def __init__(self, p_id, arrival_time, params) -> None:
         self.p_id = p_id
         self.arrival_time = arrival_time
-        self.params = Params()
+        # Shared, frozen parameters of the run
+        self.params = params
+        self.priority = None
+        self.triage_outcome = None
+        self.lab_outcome = None
+        self.bed_outcome = False
+        self.triage_wait_time = math.nan
+        self.finished_triage_time = math.nan
+        self.consultation_wait_time = math.nan
+        self.finished_consult_time = math.nan
+        self.lab_wait_time = math.nan
+        self.finished_lab_time = math.nan
+        self.bed_wait_time = math.nan
+        self.finished_bed_time = math.nan
+        # Service time of every stage drawn on arrival, None draws them as services start
+        self.demands = None
 
-    def set_priority(self):
+    def set_priority(self, streams):
         # priority_distribution = DiscreteNormal(self.params.mean_priority, self.params.stdev_priority,1,5,1)
         # self.priority = int(priority_distribution.sample()[0])
-        self.priority = random.choices([1, 2, 3, 4, 5], [0.1, 0.2, 0.4, 0.2, 0.1])[0]
+        self.priority = Priority(streams.priority.sample())
 
-    def set_outcome(self):
+    def set_outcome(self, streams):
         # decision tree - if priority 5, go to Minor Injury Unit (MIU) or home. Higher priority go to AE
         if self.priority <3:
-            self.triage_outcome = 'main'
-            self.lab_outcome = random.choices(['lab', 'no lab'], [self.params.p_main_lab, 1-self.params.p_main_lab])[0]
-            self.bed_outcome = random.choices([True, False], [self.params.p_ed, 1-self.params.p_ed])[0]
+            self.triage_outcome = TriageOutcome.MAIN
+            self.lab_outcome = LabOutcome(streams.main_lab_outcome.sample())
+            self.bed_outcome = streams.bed_outcome.sample()
         elif self.priority >= 3: # of those who are priority 5, 20% will go home with advice, 80% go to 'MIU'
-            self.triage_outcome = 'fast'
-            self.lab_outcome = random.choices(['lab', 'no lab'], [self.params.p_fast_lab, 1-self.params.p_fast_lab])[0]
+            self.triage_outcome = TriageOutcome.FAST
+            self.lab_outcome = LabOutcome(streams.fast_lab_outcome.sample())
             self.bed_outcome = False
 
+    def set_demands(self, streams):
+        # With common random numbers the patient brings the same demands to every scenario,
+        # whatever order the stages serve patients in
+        if streams.demands:
+            self.demands = [stream.sample() for stream in streams.services]
+
     def __lt__(self, other):
         return self.priority < other.priority  # Compare based on priority
 
 
 if __name__ == "__main__":
-    patient = Patient(1,1)
-    patient.set_priority()
-    patient.set_outcome()
-    for var_name, var_value in vars(patient).items():
-        print(f"{var_name}: {var_value}")
-
+    params = Params().frozen()
+    streams = RandomStreams(params, 42)
+    patient = Patient(1, 1, params)
+    patient.set_priority(streams)
+    patient.set_outcome(streams)
+    patient.set_demands(streams)
+    for var_name in Patient.__slots__:
+        print(f"{var_name}: {getattr(patient, var_name)}")
@@ -0,0 +1,344 @@
+import math
+import numpy as np
+
+# Wait time of every stage, the default KPIs of a summary
+WAIT_KPIS = ['triage_wait_time', 'consultation_wait_time', 'lab_wait_time', 'bed_wait_time']
+# Control variates recorded for every run, see utils.RandomStreams.controls
+CONTROLS = ['arrivals', 'triage', 'consult_fast', 'consult_main', 'lab_fast', 'lab_main', 'bed']
+# Controls of each wait, the arrivals and the service times of its stages. Every control
+# costs a degree of freedom, so few controls suit the tens of runs of a scenario
+KPI_CONTROLS = {
+    'triage_wait_time': ['arrivals', 'triage'],
+    'consultation_wait_time': ['arrivals', 'consult_fast', 'consult_main'],
+    'lab_wait_time': ['arrivals', 'lab_fast', 'lab_main'],
+    'bed_wait_time': ['arrivals', 'bed'],
+}
+
+def t_quantile(confidence, dof):
+    """
+    Returns the quantile of the t distribution giving a two-sided confidence interval
+    """
+    # Imported on first use, scipy.stats is slow to import
+    from scipy import stats
+    return float(stats.t.ppf(0.5 + confidence / 2, dof))
+
+class RunningStat:
+    """
+    Running mean and variance of a stream of values (Welford's algorithm)
+    """
+    def __init__(self):
+        self.n = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+
+    def update(self, value):
+        self.n += 1
+        delta = value - self.mean
+        self.mean += delta / self.n
+        self.m2 += delta * (value - self.mean)
+
+    @property
+    def variance(self):
+        return self.m2 / (self.n - 1) if self.n > 1 else math.nan
+
+    def half_width(self, confidence=0.95):
+        """
+        Returns the half-width of the t confidence interval of the mean
+        """
+        if self.n < 2:
+            return math.inf
+        return t_quantile(confidence, self.n - 1) * math.sqrt(self.variance / self.n)
+
+def control_variate_mean(responses, controls, confidence=0.95):
+    """
+    Returns the control variate estimate of the mean response and the
+    half-width of its confidence interval, by regressing the responses on
+    controls of known mean zero (Lavenberg and Welch, 1981). Observations with
+    a NaN are dropped. The half-width is infinite without enough observations,
+    at least two more than controls
+
+    Params:
+    -------
+    responses = one response per independent observation, e.g. the mean wait of a run
+    controls = one row of control values per observation
+    confidence = confidence level of the interval
+    """
+    responses = np.asarray(responses, dtype=float)
+    controls = np.asarray(controls, dtype=float)
+    if controls.ndim < 2:
+        controls = controls.reshape(len(responses), -1 if len(responses) else 0)
+    valid = ~np.isnan(responses) & ~np.isnan(controls).any(axis=1)
+    responses, controls = responses[valid], controls[valid]
+    if len(responses) == 0:
+        return math.nan, math.inf
+    # Constant controls, e.g. of a stage no patient visited, carry no information
+    controls = controls[:, np.ptp(controls, axis=0) > 0]
+    n, q = controls.shape
+    if n < q + 2:
+        return float(responses.mean()), math.inf
+    # The intercept is the response at the known mean of the controls
+    design = np.column_stack((np.ones(n), controls))
+    coefficients, _, rank, _ = np.linalg.lstsq(design, responses, rcond=None)
+    if n - rank < 1:
+        return float(responses.mean()), math.inf
+    residuals = responses - design @ coefficients
+    variance = residuals @ residuals / (n - rank) * np.linalg.pinv(design.T @ design)[0, 0]
+    return float(coefficients[0]), t_quantile(confidence, n - rank) * math.sqrt(variance)
+
+class P2Quantile:
+    """
+    Streaming estimate of one quantile in constant memory, using the P-square
+    algorithm of Jain and Chlamtac (1985)
+    """
+    def __init__(self, p):
+        """
+        Params:
+        -------
+        p = quantile to estimate, between 0 and 1
+        """
+        self.p = p
+        self.heights = []
+        self.positions = [1, 2, 3, 4, 5]
+        self.desired = [1, 1 + 2 * p, 1 + 4 * p, 3 + 2 * p, 5]
+        self.increments = [0, p / 2, p, (1 + p) / 2, 1]
+
+    def update(self, value):
+        heights = self.heights
+        if len(heights) < 5:
+            heights.append(value)
+            heights.sort()
+            return
+
+        # Find the cell of the new value, extending the extreme markers if needed
+        if value < heights[0]:
+            heights[0] = value
+            k = 0
+        elif value >= heights[4]:
+            heights[4] = value
+            k = 3
+        else:
+            k = 0
+            while value >= heights[k + 1]:
+                k += 1
+        for i in range(k + 1, 5):
+            self.positions[i] += 1
+        for i in range(5):
+            self.desired[i] += self.increments[i]
+
+        # Move the middle markers towards their desired positions
+        positions = self.positions
+        for i in range(1, 4):
+            d = self.desired[i] - positions[i]
+            if (d >= 1 and positions[i + 1] - positions[i] > 1) or (d <= -1 and positions[i - 1] - positions[i] < -1):
+                step = 1 if d > 0 else -1
+                height = self.parabolic(i, step)
+                if not heights[i - 1] < height < heights[i + 1]:
+                    height = heights[i] + step * (heights[i + step] - heights[i]) / (positions[i + step] - positions[i])
+                heights[i] = height
+                positions[i] += step
+
+    def parabolic(self, i, step):
+        q, n = self.heights, self.positions
+        return q[i] + step / (n[i + 1] - n[i - 1]) * (
+            (n[i] - n[i - 1] + step) * (q[i + 1] - q[i]) / (n[i + 1] - n[i])
+            + (n[i + 1] - n[i] - step) * (q[i] - q[i - 1]) / (n[i] - n[i - 1]))
+
+    @property
+    def value(self):
+        if not self.heights:
+            return math.nan
+        if len(self.heights) < 5:
+            # Too few values for the markers, use the exact sample quantile
+            return float(np.quantile(self.heights, self.p))
+        return self.heights[2]
+
+class StreamingSummary:
+    """
+    Summary statistics of KPIs updated as each replication finishes.
+
+    The mean of a KPI over the patients of a replication is one observation of
+    the across-replication mean, whose confidence interval drives early
+    stopping. With Params.antithetic the observation is the average of the
+    two runs of a pair, added once both have finished. Given controls, the
+    interval is the one of the control variate estimate. Quantiles are
+    estimated over every patient.
+    """
+    def __init__(self, kpis=WAIT_KPIS, quantiles=(0.5, 0.9), confidence=0.95, controls=()):
+        """
+        Params:
+        -------
+        kpis = Dataset columns to summarise
+        quantiles = patient level quantiles estimated for every KPI
+        confidence = confidence level of the intervals
+        controls = control variates of the runs narrowing the intervals, either one list
+                   for every KPI or a dict of KPI to list, e.g. KPI_CONTROLS
+        """
+        self.kpis = list(kpis)
+        self.confidence = confidence
+        self.controls = kpi_controls(controls, self.kpis)
+        self.runs = 0
+        self.means = {kpi: RunningStat() for kpi in self.kpis}
+        self.quantiles = {kpi: [P2Quantile(p) for p in quantiles] for kpi in self.kpis}
+        # KPI means and controls of every observation by run (pair with Params.antithetic),
+        # kept for the control variate estimates and for compare
+        self.observations = {}
+        # First finished run of antithetic pairs, by pair
+        self.pending = {}
+
+    def update(self, dataset):
+        """
+        Add a finished replication
+        """
+        self.runs += 1
+        for kpi in self.kpis:
+            # Runs streamed to a sink only keep a sample of their records for the quantiles
+            values = dataset.values(kpi)
+            for estimator in self.quantiles[kpi]:
+                for value in values.tolist():
+                    estimator.update(value)
+
+        observation = run_observation(dataset, self.kpis)
+        unit = dataset.run
+        if dataset.params.antithetic:
+            unit = dataset.run // 2
+            if unit not in self.pending:
+                self.pending[unit] = observation
+                return
+            observation = average(self.pending.pop(unit), observation)
+        for kpi, mean in observation[0].items():
+            if not math.isnan(mean):
+                self.means[kpi].update(mean)
+        self.observations[unit] = observation
+
+    def control_variate_mean(self, kpi):
+        """
+        Returns the control variate estimate of the mean of a KPI and its half-width
+        """
+        observations = self.observations.values()
+        return control_variate_mean([means[kpi] for means, _ in observations],
+                                    [control_row(controls, self.controls[kpi]) for _, controls in observations],
+                                    self.confidence)
+
+    def half_width(self, kpi):
+        if self.controls[kpi]:
+            return self.control_variate_mean(kpi)[1]
+        return self.means[kpi].half_width(self.confidence)
+
+    def converged(self, target_half_width, min_runs=10):
+        """
+        Returns True once every KPI has reached its target half-width
+
+        Params:
+        -------
+        target_half_width = half-width in minutes, either one value for every KPI
+                            or a dict of KPI to half-width (KPIs left out are ignored)
+        min_runs = number of replications to run before stopping is allowed
+        """
+        if self.runs < min_runs:
+            return False
+        if not isinstance(target_half_width, dict):
+            target_half_width = {kpi: target_half_width for kpi in self.kpis}
+        return all(self.half_width(kpi) <= target for kpi, target in target_half_width.items())
+
+    def as_dict(self):
+        """
+        Returns the summary of every KPI
+        """
+        summary = {}
+        for kpi in self.kpis:
+            summary[kpi] = {'runs': self.means[kpi].n, 'mean': self.means[kpi].mean,
+                            'stdev': math.sqrt(self.means[kpi].variance) if self.means[kpi].n > 1 else math.nan,
+                            'half_width': self.half_width(kpi)}
+            if self.controls[kpi]:
+                # The half-width is then the one of the control variate mean
+                summary[kpi]['cv_mean'] = self.control_variate_mean(kpi)[0]
+            for estimator in self.quantiles[kpi]:
+                summary[kpi][f"p{round(estimator.p * 100)}"] = estimator.value
+        return summary
+
+def kpi_controls(controls, kpis):
+    """
+    Returns the controls of every KPI, given one list for every KPI or a dict of KPI to list
+    """
+    if isinstance(controls, dict):
+        return {kpi: list(controls.get(kpi, ())) for kpi in kpis}
+    return {kpi: list(controls) for kpi in kpis}
+
+def control_row(controls, names):
+    return [controls.get(name, math.nan) for name in names]
+
+def run_observation(dataset, kpis):
+    """
+    Returns the KPI means and the controls of a single run dataset
+    """
+    controls = dataset.controls[-1] if dataset.controls else {}
+    return {kpi: dataset.mean(kpi) for kpi in kpis}, {name: value for name, value in controls.items() if name != 'run'}
+
+def average(first, second):
+    """
+    Returns the average of two observations, e.g. the runs of an antithetic pair
+    """
+    means = {kpi: (mean + second[0][kpi]) / 2 for kpi, mean in first[0].items()}
+    controls = {name: (value + second[1][name]) / 2 for name, value in first[1].items() if name in second[1]}
+    return means, controls
+
+def run_observations(dataset, kpis=WAIT_KPIS):
+    """
+    Returns the observations of a dataset holding several runs, e.g. from
+    sweep.run_sweep(..., collect=True), as a dict of run id (antithetic pair with Params.antithetic)
+    to the KPI means and the controls of the run. Pairs missing a run are left out
+
+    Params:
+    -------
+    dataset = Dataset of the runs
+    kpis = Dataset columns averaged over the patients of every run
+    """
+    runs = dataset.columns['run'][:dataset.size]
+    ids = sorted(set(runs.tolist()) | {row['run'] for row in dataset.controls})
+    index = np.searchsorted(ids, runs)
+    means = {}
+    for kpi in kpis:
+        values = dataset.columns[kpi][:dataset.size]
+        valid = ~np.isnan(values)
+        totals = np.bincount(index[valid], values[valid], minlength=len(ids))
+        counts = np.bincount(index[valid], minlength=len(ids))
+        with np.errstate(invalid='ignore', divide='ignore'):
+            means[kpi] = totals / counts
+    rows = {row['run']: {name: value for name, value in row.items() if name != 'run'} for row in dataset.controls}
+    observations = {run: ({kpi: float(means[kpi][i]) for kpi in kpis}, rows.get(run, {}))
+                    for i, run in enumerate(ids)}
+    if not dataset.params.antithetic:
+        return observations
+    return {pair: average(observations[2 * pair], observations[2 * pair + 1])
+            for pair in sorted({run // 2 for run in ids})
+            if 2 * pair in observations and 2 * pair + 1 in observations}
+
+def compare(first, second, kpis=WAIT_KPIS, controls=(), confidence=0.95):
+    """
+    Returns the mean difference (second minus first) of every KPI between two
+    scenarios run with the same seed, paired run by run so that common random
+    numbers cancel out of the difference, with the half-width of its
+    confidence interval
+
+    Params:
+    -------
+    first, second = runs of each scenario, either Datasets holding them or the StreamingSummary
+                    of the runs, e.g. from sweep.run_sweep
+    kpis = Dataset columns compared, summaries must have been given them
+    controls = control variates narrowing the intervals, averaged over both scenarios,
+               one list for every KPI or a dict of KPI to list, e.g. KPI_CONTROLS
+    confidence = confidence level of the intervals
+    """
+    observations = [runs.observations if isinstance(runs, StreamingSummary) else run_observations(runs, kpis)
+                    for runs in (first, second)]
+    units = sorted(set(observations[0]) & set(observations[1]))
+    controls = kpi_controls(controls, kpis)
+    comparison = {}
+    for kpi in kpis:
+        differences = [observations[1][unit][0][kpi] - observations[0][unit][0][kpi] for unit in units]
+        rows = [control_row(average(observations[0][unit], observations[1][unit])[1], controls[kpi])
+                for unit in units]
+        difference, half_width = control_variate_mean(differences, rows, confidence)
+        comparison[kpi] = {'runs': int(np.sum(~np.isnan(differences))), 'difference': difference,
+                           'half_width': half_width}
+    return comparison
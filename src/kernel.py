@@ -0,0 +1,349 @@
+"""
+Specialised event kernel for the ED network.
+
+The SimPy model runs a generator process per patient and stage, each with a
+request event and a timeout. This kernel models the fixed triage -> fast/main
+consultation -> lab -> bed network directly: one heap of service completions,
+the arrival schedule walked in order and one array-backed queue per station
+(a deque for FIFO stations, a heap keyed like SimPy's PriorityRequest for the
+priority ones).
+
+Given the same random streams it reproduces the SimPy path record for record:
+every stream is consumed in the same order, times are computed with the same
+arithmetic and events at the end of the run are excluded the same way. Select
+it per run with Params(engine='kernel'); validate() compares both engines.
+"""
+import heapq
+import itertools
+import time
+from collections import deque
+import numpy as np
+from entities import Patient, TriageOutcome, LabOutcome
+from utils import replication_streams
+from tracing import *
+from arrivals import arrival_chunks, expected_arrivals
+from monitoring import Monitor
+from dataset import Dataset
+
+class Station:
+    """
+    Multi-server queue of one stage
+    """
+    __slots__ = ('stage', 'capacity', 'busy', 'queue', 'ordered', 'sequence', 'sample', 'monitor')
+
+    def __init__(self, stage, capacity, ordered, sample, monitor):
+        """
+        Params:
+        -------
+        stage = stage code, see tracing.STAGES
+        capacity = number of servers
+        ordered = whether the queue is ordered by patient priority, otherwise FIFO
+        sample = function drawing a service time
+        monitor = Monitor of the station
+        """
+        self.stage = stage
+        self.capacity = capacity
+        self.busy = 0
+        self.ordered = ordered
+        self.queue = [] if ordered else deque()
+        self.sequence = 0
+        self.sample = sample
+        self.monitor = monitor
+
+    @property
+    def patients(self):
+        """
+        Number of patients at the stage, waiting or in service
+        """
+        return self.busy + len(self.queue)
+
+    def join(self, patient, now):
+        """
+        Adds a patient to the station, returns True if a server takes them now
+        """
+        if self.busy < self.capacity:
+            self.busy += 1
+            self.monitor.update(now, self.busy, len(self.queue))
+            return True
+        if self.ordered:
+            # Same key as a SimPy PriorityRequest: priority, request time, then insertion order
+            self.sequence += 1
+            heapq.heappush(self.queue, (patient.priority, now, self.sequence, patient))
+        else:
+            self.queue.append(patient)
+        self.monitor.update(now, self.busy, len(self.queue))
+        return False
+
+    def release(self, now):
+        self.busy -= 1
+        self.monitor.update(now, self.busy, len(self.queue))
+
+    def next_patient(self, now):
+        """
+        Returns the next waiting patient if a server is free, None otherwise
+        """
+        if not self.queue or self.busy >= self.capacity:
+            return None
+        patient = heapq.heappop(self.queue)[3] if self.ordered else self.queue.popleft()
+        self.busy += 1
+        self.monitor.update(now, self.busy, len(self.queue))
+        return patient
+
+class Kernel:
+    """
+    One replication of the ED network
+    """
+    def __init__(self, params, dataset, streams, tracer=None, now=0):
+        """
+        Params:
+        -------
+        params = frozen simulation parameters
+        dataset = Dataset receiving the patients leaving the ED
+        streams = RandomStreams of the run
+        tracer = optional Tracer
+        now = simulation time the run starts at
+        """
+        self.params = params
+        self.dataset = dataset
+        self.streams = streams
+        self.tracer = tracer
+        self.now = now
+        # Service completions as (time, sequence, station, patient)
+        self.events = []
+        self.sequence = 0
+        # Residual service time and service start of patients resumed from a snapshot
+        self.resumed = {}
+        monitor = lambda capacity: Monitor(now, capacity, params.warm_up, params.monitor_interval)
+        stations = [
+            (TRIAGE, params.number_triage, False, streams.triage.sample),
+            (CONSULT_FAST, params.number_docs_fast, False, streams.consult_fast.sample),
+            (CONSULT_MAIN, params.number_docs_main, True, streams.consult_main.sample),
+            (LAB_FAST, params.number_nurses_fast, False, streams.lab_fast.sample),
+            (LAB_MAIN, params.number_nurses_main, True, streams.lab_main.sample),
+            (BED, params.number_of_beds, True, streams.bed.sample),
+        ]
+        self.stations = [Station(stage, capacity, ordered, sample, monitor(capacity))
+                         for stage, capacity, ordered, sample in stations]
+
+    def trace(self, level, patient, station, event):
+        self.tracer.record(level, self.now, patient.p_id, station.stage, event, len(station.queue), station.busy)
+
+    def add_patient(self, station, patient):
+        """
+        Patient joins a station, starting service straight away if a server is free
+        """
+        if self.tracer is not None:
+            self.trace(QUEUE, patient, station, QUEUED)
+        if station.join(patient, self.now):
+            self.start(station, patient)
+
+    def resume_patient(self, stage, patient, service_time=None, service_start=None):
+        """
+        Put a patient from a snapshot back in a stage, in service for the
+        remaining service_time if given, otherwise waiting
+        """
+        if service_time is not None:
+            self.resumed[patient.p_id] = (service_time, service_start)
+        station = self.stations[stage]
+        if station.join(patient, self.now):
+            self.start(station, patient)
+
+    def start(self, station, patient):
+        """
+        Starts the service of a patient who took a server
+        """
+        now = self.now
+        if self.tracer is not None:
+            self.trace(SERVICE, patient, station, START)
+        resumed = self.resumed.pop(patient.p_id, None) if self.resumed else None
+        if resumed is None:
+            service_time = station.sample() if patient.demands is None else patient.demands[station.stage]
+            wait_start_time = now
+        else:
+            service_time, wait_start_time = resumed
+            if wait_start_time is None:
+                wait_start_time = now
+
+        # Waits are known when the service starts, SimPy sets the same values at its end
+        stage = station.stage
+        if stage == TRIAGE:
+            patient.triage_wait_time = wait_start_time - patient.arrival_time
+        elif stage == CONSULT_FAST or stage == CONSULT_MAIN:
+            patient.consultation_wait_time = wait_start_time - patient.finished_triage_time
+        elif stage == LAB_FAST or stage == LAB_MAIN:
+            patient.lab_wait_time = wait_start_time - patient.finished_consult_time
+        elif patient.lab_outcome == LabOutcome.LAB:
+            patient.bed_wait_time = wait_start_time - patient.finished_lab_time
+        else:
+            patient.bed_wait_time = wait_start_time - patient.finished_consult_time
+        self.sequence += 1
+        heapq.heappush(self.events, (now + service_time, self.sequence, station, patient))
+
+    def finish(self, station, patient):
+        """
+        Ends the service of a patient, routes them and hands the server to the next one
+        """
+        now = self.now
+        stations = self.stations
+        stage = station.stage
+        if self.tracer is not None:
+            self.trace(SERVICE, patient, station, FINISH)
+        station.release(now)
+
+        destination = None
+        if stage == TRIAGE:
+            patient.finished_triage_time = now
+            destination = stations[CONSULT_MAIN]
+            if patient.triage_outcome == TriageOutcome.FAST and stations[CONSULT_FAST].patients <= destination.patients:
+                destination = stations[CONSULT_FAST]
+        elif stage == CONSULT_FAST:
+            patient.finished_consult_time = now
+            if patient.lab_outcome == LabOutcome.LAB:
+                destination = stations[LAB_FAST]
+        elif stage == CONSULT_MAIN:
+            patient.finished_consult_time = now
+            if patient.lab_outcome == LabOutcome.LAB:
+                destination = stations[LAB_MAIN]
+            elif patient.bed_outcome:
+                destination = stations[BED]
+        elif stage == LAB_FAST:
+            patient.finished_lab_time = now
+        elif stage == LAB_MAIN:
+            patient.finished_lab_time = now
+            if patient.bed_outcome:
+                destination = stations[BED]
+        else:
+            patient.finished_bed_time = now
+
+        if destination is None:
+            self.dataset.add_patient(patient)
+            if self.tracer is not None:
+                self.trace(SERVICE, patient, station, EXIT)
+        else:
+            self.add_patient(destination, patient)
+
+        following = station.next_patient(now)
+        if following is not None:
+            self.start(station, following)
+
+    def run(self, arrival_times, until, first_p_id=1):
+        """
+        Simulates the arrivals and service completions before until
+
+        Params:
+        -------
+        arrival_times = iterable of the sorted arrival times
+        until = end of the run, events at that time are not processed
+        first_p_id = id of the first arriving patient
+        """
+        events = self.events
+        params = self.params
+        streams = self.streams
+        triage = self.stations[TRIAGE]
+        arrivals = iter(arrival_times)
+        p_id = first_p_id
+        previous = self.now
+        next_arrival = next(arrivals, None)
+        while True:
+            if events and (next_arrival is None or events[0][0] < next_arrival):
+                if events[0][0] >= until:
+                    break
+                self.now, _, station, patient = heapq.heappop(events)
+                self.finish(station, patient)
+            elif next_arrival is not None:
+                # The SimPy generator only wakes at its own timeouts, so the delay is
+                # added to the previous arrival, previous + (arrival - previous)
+                if next_arrival > previous:
+                    previous = previous + (next_arrival - previous)
+                self.now = previous
+                patient = Patient(p_id, previous, params)
+                patient.set_priority(streams)
+                patient.set_outcome(streams)
+                patient.set_demands(streams)
+                self.add_patient(triage, patient)
+                p_id += 1
+                next_arrival = next(arrivals, None)
+            else:
+                break
+
+def run_kernel_replication(params, run, trace=None, snapshot=None, sink=None, batch_size=4096, profiler=None):
+    """
+    Runs one replication with the kernel and returns its Dataset, see main.run_replication
+    """
+    params = params.frozen()
+    streams = replication_streams(params, run)
+    tracer = trace.open(run) if trace is not None else None
+    dataset = Dataset(params, run, sink=sink, batch_size=batch_size)
+    until = params.warm_up + params.sim_duration
+    if profiler is not None:
+        profiler.instrument_streams(streams)
+        profiler.instrument_dataset(dataset)
+
+    start = snapshot.time if snapshot is not None else 0
+    kernel = Kernel(params, dataset, streams, tracer, start)
+    if profiler is not None:
+        profiler.instrument_kernel(kernel)
+    if snapshot is not None:
+        snapshot.restore(kernel, params)
+    chunks = arrival_chunks(params, streams.arrivals, streams.thinning, until, start, include_start=snapshot is None,
+                            chunk_size=batch_size if sink is not None else None)
+    arrival_times = itertools.chain.from_iterable(chunk.tolist() for chunk in chunks)
+    kernel.run(arrival_times, until, snapshot.next_p_id if snapshot is not None else 1)
+
+    if tracer is not None:
+        tracer.close()
+    for station in kernel.stations:
+        dataset.add_resource(STAGES[station.stage], station.monitor.summary(until), station.monitor.series)
+    dataset.add_controls(streams.controls(expected_arrivals(params, start, until, snapshot is None)))
+    dataset.finalise()
+    return dataset
+
+def validate(params, runs=5, verbose=True):
+    """
+    Runs both engines on the same runs and returns the differences found, an
+    empty list when the kernel reproduces SimPy exactly
+
+    Params:
+    -------
+    params = simulation parameters
+    runs = number of runs compared
+    verbose = print the patients compared and the time taken by each engine
+    """
+    from main import run_replication
+    simpy_params = type(params)(**{**params.overrides(), 'engine': 'simpy'})
+    kernel_params = type(params)(**{**params.overrides(), 'engine': 'kernel'})
+    differences = []
+    seconds = {'simpy': 0.0, 'kernel': 0.0}
+    patients = 0
+    for run in range(runs):
+        started = time.perf_counter()
+        expected = run_replication(simpy_params, run)
+        seconds['simpy'] += time.perf_counter() - started
+        started = time.perf_counter()
+        actual = run_replication(kernel_params, run)
+        seconds['kernel'] += time.perf_counter() - started
+
+        patients += expected.size
+        if actual.size != expected.size:
+            differences.append(f"run {run}: {actual.size} patients, SimPy recorded {expected.size}")
+            continue
+        for name, column in expected.columns.items():
+            if not np.array_equal(actual.columns[name][:actual.size], column[:expected.size], equal_nan=column.dtype.kind == 'f'):
+                differences.append(f"run {run}: column {name} differs")
+        if actual.resources != expected.resources:
+            differences.append(f"run {run}: resource statistics differ")
+        if actual.series != expected.series:
+            differences.append(f"run {run}: resource time series differ")
+    if verbose:
+        print(f"{runs} runs, {patients} patients: SimPy {seconds['simpy']:.2f}s, kernel {seconds['kernel']:.2f}s "
+              f"({seconds['simpy'] / max(seconds['kernel'], 1e-9):.1f}x), {len(differences)} differences")
+    return differences
+
+if __name__ == "__main__":
+    from parameters import Params
+    profile = [0.5] * 6 + [1.5] * 12 + [0.5] * 6
+    for differences in (validate(Params()), validate(Params(mean_interarrival=5, monitor_interval=15)),
+                        validate(Params(arrival_profile=profile)),
+                        validate(Params(arrival_profile=profile, antithetic=True))):
+        for difference in differences:
+            print(difference)
@@ -1,314 +1,564 @@
-from entities import Patient
+from entities import Patient, TriageOutcome, LabOutcome
 import simpy
-import random
-import pandas as pd
 from utils import *
-from parameters import Params
+from tracing import *
+from arrivals import arrival_chunks, expected_arrivals
+from monitoring import MonitoredResource, MonitoredPriorityResource
+from kernel import run_kernel_replication
 from dataset import Dataset
-import heapq
-
-# Set a seed for reproducibility
-random.seed(42)
+from estimators import StreamingSummary, WAIT_KPIS
+from writers import open_writer, remove_output
+from concurrent.futures import ProcessPoolExecutor
+from collections import deque
+from contextlib import nullcontext
+import itertools
+import os
+import time
 
 class Triage:
-    def __init__(self, env, fast_consultation, main_consultation, params):
+    def __init__(self, env, fast_consultation, main_consultation, params, streams, tracer=None):
         self.env = env
         self.params = params
-        self.queue = []
+        self.streams = streams
+        self.tracer = tracer
         self.fast_consultation = fast_consultation
         self.main_consultation = main_consultation
-        self.triage_resource = simpy.Resource(env, self.params.number_triage)
+        self.triage_resource = MonitoredResource(env, self.params.number_triage, self.params.warm_up, self.params.monitor_interval)
 
     def add_patient(self, patient):
-        patient.set_priority()
-        patient.set_outcome()
-        self.queue.append(patient)
-        print(f"Patient {patient.p_id} is queued at {self.env.now}.")
+        patient.set_priority(self.streams)
+        patient.set_outcome(self.streams)
+        patient.set_demands(self.streams)
+        if self.tracer is not None:
+            self.tracer.record(QUEUE, self.env.now, patient.p_id, TRIAGE, QUEUED, len(self.triage_resource.queue), self.triage_resource.count)
         self.env.process(self.attend_patient(patient))
 
-    def attend_patient(self, patient):
+    def resume_patient(self, patient, service_time=None, service_start=None):
+        """
+        Put a patient from a snapshot back in the stage, in service for the
+        remaining service_time if given, otherwise waiting
+        """
+        self.env.process(self.attend_patient(patient, service_time, service_start))
+
+    def attend_patient(self, patient, service_time=None, service_start=None):
         with self.triage_resource.request() as request:
-            
+            request.patient = patient
             yield request
-            wait_start_time = self.env.now
+            wait_start_time = self.env.now if service_start is None else service_start
+            if self.tracer is not None:
+                self.tracer.record(SERVICE, self.env.now, patient.p_id, TRIAGE, START, len(self.triage_resource.queue), self.triage_resource.count)
 
             # Simulate time taken to attend to the patient
-            lognorm = Lognormal(mean=self.params.mean_triage, stdev=self.params.stdev_triage)
-            service_time = lognorm.sample()
+            if service_time is None:
+                service_time = self.streams.service_time(TRIAGE, patient)
+            request.service_end = self.env.now + service_time
             yield self.env.timeout(service_time)
-            print(f"Time {self.env.now}: TRIAGE resource utilization {self.triage_resource.count}/{self.triage_resource.capacity}, Queue: {len(self.triage_resource.queue)}")
+            if self.tracer is not None:
+                self.tracer.record(SERVICE, self.env.now, patient.p_id, TRIAGE, FINISH, len(self.triage_resource.queue), self.triage_resource.count)
 
             # Calculate wait time
             patient.triage_wait_time = wait_start_time - patient.arrival_time
             patient.finished_triage_time = self.env.now
-            print(f"Patient {patient.p_id} finished triage {self.env.now} after waiting {patient.triage_wait_time} time units at the triage.")
             
 
         # Add patient to consultation queue
-        main_queue_length = len(self.main_consultation.queue)
-        fast_queue_length = len(self.fast_consultation.queue)
+        main_queue_length = self.main_consultation.consultation_resource.patients
+        fast_queue_length = self.fast_consultation.consultation_resource.patients
         
         #Decision to go fast or main consult based on queue length
-        if patient.triage_outcome == 'fast':
+        if patient.triage_outcome == TriageOutcome.FAST:
             if fast_queue_length <= main_queue_length:
-                print("FAST CONSULT")
                 self.fast_consultation.add_patient(patient)
             else:
-                print("MAIN CONSULT")
                 self.main_consultation.add_patient(patient)
         else:
-            print("MAIN CONSULT")
             self.main_consultation.add_patient(patient)
-            
-        # Finish attending
-        self.queue.pop(0)
 
 
 class FastConsultation:
-    def __init__(self, env, fast_lab, dataset, params):
+    def __init__(self, env, fast_lab, dataset, params, streams, tracer=None):
         self.env = env
         self.params = params
-        self.queue = []
+        self.streams = streams
+        self.tracer = tracer
         self.fast_lab = fast_lab
-        self.consultation_resource = simpy.Resource(env, self.params.number_docs_fast)
+        self.consultation_resource = MonitoredResource(env, self.params.number_docs_fast, self.params.warm_up, self.params.monitor_interval)
         self.dataset = dataset
 
     def add_patient(self, patient):
-        self.queue.append(patient)
-        print(f"Patient {patient.p_id} added to consultation queue at {self.env.now}.")
+        if self.tracer is not None:
+            self.tracer.record(QUEUE, self.env.now, patient.p_id, CONSULT_FAST, QUEUED, len(self.consultation_resource.queue), self.consultation_resource.count)
         self.env.process(self.consult_patient(patient))
 
-    def consult_patient(self, patient):
+    def resume_patient(self, patient, service_time=None, service_start=None):
+        """
+        Put a patient from a snapshot back in the stage, in service for the
+        remaining service_time if given, otherwise waiting
+        """
+        self.env.process(self.consult_patient(patient, service_time, service_start))
+
+    def consult_patient(self, patient, service_time=None, service_start=None):
         with self.consultation_resource.request() as request:
+            request.patient = patient
             yield request  # Wait for a spot in the consultation area
-            wait_start_time = self.env.now
+            wait_start_time = self.env.now if service_start is None else service_start
+            if self.tracer is not None:
+                self.tracer.record(SERVICE, self.env.now, patient.p_id, CONSULT_FAST, START, len(self.consultation_resource.queue), self.consultation_resource.count)
         
             # Simulate time taken to consult the patient
-            lognorm = Lognormal(mean=self.params.mean_doc_consult_fast, stdev=self.params.stdev_doc_consult_fast)
-            consultation_time = lognorm.sample()
-            yield self.env.timeout(consultation_time)
+            if service_time is None:
+                service_time = self.streams.service_time(CONSULT_FAST, patient)
+            request.service_end = self.env.now + service_time
+            yield self.env.timeout(service_time)
             patient.consultation_wait_time = wait_start_time - patient.finished_triage_time
             patient.finished_consult_time = self.env.now
-            print(f"Time {self.env.now}: Resource utilization {self.consultation_resource.count}/{self.consultation_resource.capacity}, Queue: {len(self.consultation_resource.queue)}")
+            if self.tracer is not None:
+                self.tracer.record(SERVICE, self.env.now, patient.p_id, CONSULT_FAST, FINISH, len(self.consultation_resource.queue), self.consultation_resource.count)
 
-            print(f"Patient {patient.p_id} consulted FAST at {self.env.now} after waiting {patient.consultation_wait_time} time units after triage.")
         #decision to go lab
-        if patient.lab_outcome == 'lab':
-            print("FAST LAB")
+        if patient.lab_outcome == LabOutcome.LAB:
             self.fast_lab.add_patient(patient)
         else:
-            self.dataset.patient_list.append(patient)
-
-        # Finish consulting
-        self.queue.pop(0)
+            self.dataset.add_patient(patient)
+            if self.tracer is not None:
+                self.tracer.record(SERVICE, self.env.now, patient.p_id, CONSULT_FAST, EXIT, len(self.consultation_resource.queue), self.consultation_resource.count)
 
 class MainConsultation:
-    def __init__(self, env, main_lab, bed, dataset, params):
+    def __init__(self, env, main_lab, bed, dataset, params, streams, tracer=None):
         self.env = env
         self.params = params
-        self.queue = []
+        self.streams = streams
+        self.tracer = tracer
         self.main_lab = main_lab
         self.bed = bed
-        self.consultation_resource = simpy.PriorityResource(env, self.params.number_docs_main)
+        self.consultation_resource = MonitoredPriorityResource(env, self.params.number_docs_main, self.params.warm_up, self.params.monitor_interval)
         self.dataset = dataset
 
     def add_patient(self, patient):
-        heapq.heappush(self.queue, (patient.priority, patient))
-        print(f"Patient {patient.p_id} added to consultation queue at {self.env.now}.")
+        if self.tracer is not None:
+            self.tracer.record(QUEUE, self.env.now, patient.p_id, CONSULT_MAIN, QUEUED, len(self.consultation_resource.queue), self.consultation_resource.count)
         self.env.process(self.consult_patient(patient))
 
-    def consult_patient(self, patient):
+    def resume_patient(self, patient, service_time=None, service_start=None):
+        """
+        Put a patient from a snapshot back in the stage, in service for the
+        remaining service_time if given, otherwise waiting
+        """
+        self.env.process(self.consult_patient(patient, service_time, service_start))
+
+    def consult_patient(self, patient, service_time=None, service_start=None):
         with self.consultation_resource.request(priority=patient.priority) as request:
+            request.patient = patient
             yield request  # Wait for a spot in the consultation area
-            wait_start_time = self.env.now
+            wait_start_time = self.env.now if service_start is None else service_start
+            if self.tracer is not None:
+                self.tracer.record(SERVICE, self.env.now, patient.p_id, CONSULT_MAIN, START, len(self.consultation_resource.queue), self.consultation_resource.count)
         
             # Simulate time taken to consult the patient
-            lognorm = Lognormal(mean=self.params.mean_doc_consult_main, stdev=self.params.stdev_doc_consult_main)
-            consultation_time = lognorm.sample()
-            yield self.env.timeout(consultation_time)
+            if service_time is None:
+                service_time = self.streams.service_time(CONSULT_MAIN, patient)
+            request.service_end = self.env.now + service_time
+            yield self.env.timeout(service_time)
             patient.consultation_wait_time = wait_start_time - patient.finished_triage_time
             patient.finished_consult_time = self.env.now
-            print(f"Time {self.env.now}: Resource utilization {self.consultation_resource.count}/{self.consultation_resource.capacity}, Queue: {len(self.consultation_resource.queue)}")
+            if self.tracer is not None:
+                self.tracer.record(SERVICE, self.env.now, patient.p_id, CONSULT_MAIN, FINISH, len(self.consultation_resource.queue), self.consultation_resource.count)
 
-            print(f"Patient {patient.p_id} consulted MAIN at {self.env.now} after waiting {patient.consultation_wait_time} time units after triage.")
 
         # Decision to go lab or get bedded or go home
-        if patient.lab_outcome == 'lab':
-            print("MAIN LAB")
+        if patient.lab_outcome == LabOutcome.LAB:
             self.main_lab.add_patient(patient)
         else:
             if patient.bed_outcome:
-                print("BED FROM CONSULT")
                 self.bed.add_patient(patient)
             else:
-                self.dataset.patient_list.append(patient)
-
-        # Finish consulting
-        self.queue.pop(0)
+                self.dataset.add_patient(patient)
+                if self.tracer is not None:
+                    self.tracer.record(SERVICE, self.env.now, patient.p_id, CONSULT_MAIN, EXIT, len(self.consultation_resource.queue), self.consultation_resource.count)
 
 class FastLab:
-    def __init__(self, env, dataset, params):
+    def __init__(self, env, dataset, params, streams, tracer=None):
         self.env = env
         self.params = params
-        self.queue = []
-        self.lab_resource = simpy.Resource(env, self.params.number_nurses_fast)
+        self.streams = streams
+        self.tracer = tracer
+        self.lab_resource = MonitoredResource(env, self.params.number_nurses_fast, self.params.warm_up, self.params.monitor_interval)
         self.dataset = dataset
 
     def add_patient(self, patient):
-        self.queue.append(patient)
-        print(f"Patient {patient.p_id} added to FAST lab queue at {self.env.now}.")
+        if self.tracer is not None:
+            self.tracer.record(QUEUE, self.env.now, patient.p_id, LAB_FAST, QUEUED, len(self.lab_resource.queue), self.lab_resource.count)
         self.env.process(self.lab_patient(patient))
 
-    def lab_patient(self, patient):
+    def resume_patient(self, patient, service_time=None, service_start=None):
+        """
+        Put a patient from a snapshot back in the stage, in service for the
+        remaining service_time if given, otherwise waiting
+        """
+        self.env.process(self.lab_patient(patient, service_time, service_start))
+
+    def lab_patient(self, patient, service_time=None, service_start=None):
         with self.lab_resource.request() as request:
+            request.patient = patient
             yield request  # Wait for a spot in the consultation area
-            wait_start_time = self.env.now
+            wait_start_time = self.env.now if service_start is None else service_start
+            if self.tracer is not None:
+                self.tracer.record(SERVICE, self.env.now, patient.p_id, LAB_FAST, START, len(self.lab_resource.queue), self.lab_resource.count)
         
             # Simulate time taken to consult the patient
-            lognorm = Lognormal(mean=self.params.mean_lab_fast, stdev=self.params.stdev_lab_fast)
-            lab_time = lognorm.sample()
-            yield self.env.timeout(lab_time)
+            if service_time is None:
+                service_time = self.streams.service_time(LAB_FAST, patient)
+            request.service_end = self.env.now + service_time
+            yield self.env.timeout(service_time)
             patient.lab_wait_time = wait_start_time - patient.finished_consult_time
             patient.finished_lab_time = self.env.now
-            print(f"Time {self.env.now}: FAST LAB Resource utilization {self.lab_resource.count}/{self.lab_resource.capacity}, Queue: {len(self.lab_resource.queue)}")
+            if self.tracer is not None:
+                self.tracer.record(SERVICE, self.env.now, patient.p_id, LAB_FAST, FINISH, len(self.lab_resource.queue), self.lab_resource.count)
 
-            print(f"Patient {patient.p_id} finished lab FAST at {self.env.now} after waiting {patient.lab_wait_time} time units after consultation.")
 
         # Finish lab, output the patient
-        self.dataset.patient_list.append(patient)
-        self.queue.pop(0)
+        self.dataset.add_patient(patient)
+        if self.tracer is not None:
+            self.tracer.record(SERVICE, self.env.now, patient.p_id, LAB_FAST, EXIT, len(self.lab_resource.queue), self.lab_resource.count)
 
 class MainLab:
-    def __init__(self, env, bed, dataset, params):
+    def __init__(self, env, bed, dataset, params, streams, tracer=None):
         self.env = env
         self.params = params
-        self.queue = []
+        self.streams = streams
+        self.tracer = tracer
         self.bed = bed
-        self.lab_resource = simpy.PriorityResource(env, self.params.number_nurses_main)
+        self.lab_resource = MonitoredPriorityResource(env, self.params.number_nurses_main, self.params.warm_up, self.params.monitor_interval)
         self.dataset = dataset
 
     def add_patient(self, patient):
-        heapq.heappush(self.queue, (patient.priority, patient))
-        print(f"Patient {patient.p_id} added to MAIN lab queue at {self.env.now}.")
+        if self.tracer is not None:
+            self.tracer.record(QUEUE, self.env.now, patient.p_id, LAB_MAIN, QUEUED, len(self.lab_resource.queue), self.lab_resource.count)
         self.env.process(self.lab_patient(patient))
 
-    def lab_patient(self, patient):
+    def resume_patient(self, patient, service_time=None, service_start=None):
+        """
+        Put a patient from a snapshot back in the stage, in service for the
+        remaining service_time if given, otherwise waiting
+        """
+        self.env.process(self.lab_patient(patient, service_time, service_start))
+
+    def lab_patient(self, patient, service_time=None, service_start=None):
         with self.lab_resource.request(priority=patient.priority) as request:
+            request.patient = patient
             yield request  # Wait for a spot in the lab area
-            wait_start_time = self.env.now
+            wait_start_time = self.env.now if service_start is None else service_start
+            if self.tracer is not None:
+                self.tracer.record(SERVICE, self.env.now, patient.p_id, LAB_MAIN, START, len(self.lab_resource.queue), self.lab_resource.count)
         
             # Simulate time taken to lab the patient
-            lognorm = Lognormal(mean=self.params.mean_lab_main, stdev=self.params.stdev_lab_main)
-            lab_time = lognorm.sample()
-            yield self.env.timeout(lab_time)
+            if service_time is None:
+                service_time = self.streams.service_time(LAB_MAIN, patient)
+            request.service_end = self.env.now + service_time
+            yield self.env.timeout(service_time)
             patient.lab_wait_time = wait_start_time - patient.finished_consult_time
             patient.finished_lab_time = self.env.now
-            print(f"Time {self.env.now}: MAIN LAB Resource utilization {self.lab_resource.count}/{self.lab_resource.capacity}, Queue: {len(self.lab_resource.queue)}")
+            if self.tracer is not None:
+                self.tracer.record(SERVICE, self.env.now, patient.p_id, LAB_MAIN, FINISH, len(self.lab_resource.queue), self.lab_resource.count)
 
-            print(f"Patient {patient.p_id} finished lab MAIN at {self.env.now} after waiting {patient.lab_wait_time} time units after consultation.")
 
         if patient.bed_outcome:
-            print("BED FROM LAB")
             self.bed.add_patient(patient)
         else:
-            self.dataset.patient_list.append(patient)
+            self.dataset.add_patient(patient)
+            if self.tracer is not None:
+                self.tracer.record(SERVICE, self.env.now, patient.p_id, LAB_MAIN, EXIT, len(self.lab_resource.queue), self.lab_resource.count)
 
-        # Finished lab
-        self.queue.pop(0)
 
 class BedAssignment:
-    def __init__(self, env, dataset, params):
+    def __init__(self, env, dataset, params, streams, tracer=None):
         self.env = env
         self.params = params
-        self.queue = []
-        self.bed_resource = simpy.PriorityResource(env, self.params.number_of_beds)
+        self.streams = streams
+        self.tracer = tracer
+        self.bed_resource = MonitoredPriorityResource(env, self.params.number_of_beds, self.params.warm_up, self.params.monitor_interval)
         self.dataset = dataset
 
     def add_patient(self, patient):
-        heapq.heappush(self.queue, (patient.priority, patient))
-        print(f"Patient {patient.p_id} added to bed queue at {self.env.now}.")
+        if self.tracer is not None:
+            self.tracer.record(QUEUE, self.env.now, patient.p_id, BED, QUEUED, len(self.bed_resource.queue), self.bed_resource.count)
         self.env.process(self.bed_patient(patient))
 
-    def bed_patient(self, patient):
+    def resume_patient(self, patient, service_time=None, service_start=None):
+        """
+        Put a patient from a snapshot back in the stage, in service for the
+        remaining service_time if given, otherwise waiting
+        """
+        self.env.process(self.bed_patient(patient, service_time, service_start))
+
+    def bed_patient(self, patient, service_time=None, service_start=None):
         with self.bed_resource.request(priority=patient.priority) as request:
+            request.patient = patient
             yield request  # Wait for a spot in the consultation area
-            wait_start_time = self.env.now
+            wait_start_time = self.env.now if service_start is None else service_start
+            if self.tracer is not None:
+                self.tracer.record(SERVICE, self.env.now, patient.p_id, BED, START, len(self.bed_resource.queue), self.bed_resource.count)
         
             # Simulate time taken to consult the patient
-            bed_time = random.expovariate(1.0 / params.mean_bed_time)
-            yield self.env.timeout(bed_time)
-            if patient.lab_outcome == 'lab':
+            if service_time is None:
+                service_time = self.streams.service_time(BED, patient)
+            request.service_end = self.env.now + service_time
+            yield self.env.timeout(service_time)
+            if patient.lab_outcome == LabOutcome.LAB:
                 patient.bed_wait_time = wait_start_time - patient.finished_lab_time
             else:
                 patient.bed_wait_time = wait_start_time - patient.finished_consult_time
             patient.finished_bed_time = self.env.now
-            print(f"Time {self.env.now}: Resource utilization {self.bed_resource.count}/{self.bed_resource.capacity}, Queue: {len(self.bed_resource.queue)}")
-
-            print(f"Patient {patient.p_id} finished staying in bed at {self.env.now} after waiting {patient.bed_wait_time} time units after consultation.")
+            if self.tracer is not None:
+                self.tracer.record(SERVICE, self.env.now, patient.p_id, BED, FINISH, len(self.bed_resource.queue), self.bed_resource.count)
 
         # Finish consulting and move to the next patient if available
-        self.dataset.patient_list.append(patient)
-        self.queue.pop(0)
-
-
-def patient_generator(env, params, triage):
-    patient_id = 1
-    while True:
-        arrival_time = env.now
-        patient = Patient(patient_id, arrival_time)
-        triage.add_patient(patient)
-        patient_id += 1
-
-        # Simulate inter-arrival time
-        yield env.timeout(random.expovariate(1.0 / params.mean_interarrival))
-
-def run_simulator(params, save_file_name):
+        self.dataset.add_patient(patient)
+        if self.tracer is not None:
+            self.tracer.record(SERVICE, self.env.now, patient.p_id, BED, EXIT, len(self.bed_resource.queue), self.bed_resource.count)
+
+
+def patient_generator(env, params, triage, streams, start=0.0, first_p_id=1, chunk_size=None):
+    # Arrival times are generated in bulk, the whole run up front unless chunk_size
+    # bounds the chunks. A run resumed from a snapshot draws its first arrival after the snapshot time
+    chunks = arrival_chunks(params, streams.arrivals, streams.thinning, params.warm_up + params.sim_duration,
+                            start, include_start=start == 0, chunk_size=chunk_size)
+    patient_ids = itertools.count(first_p_id)
+    for chunk in chunks:
+        # The chunk comes first so zip stops without drawing an unused id
+        for arrival_time, patient_id in zip(chunk.tolist(), patient_ids):
+            # Simulate inter-arrival time
+            if arrival_time > env.now:
+                yield env.timeout(arrival_time - env.now)
+            patient = Patient(patient_id, env.now, params)
+            triage.add_patient(patient)
+
+class EmergencyDepartment:
+    """
+    The stages of one replication, wired together
+    """
+    def __init__(self, env, params, dataset, streams, tracer=None):
+        self.env = env
+        self.bed = BedAssignment(env, dataset, params, streams, tracer)
+        self.fast_lab = FastLab(env, dataset, params, streams, tracer)
+        self.main_lab = MainLab(env, self.bed, dataset, params, streams, tracer)
+        self.fast_consultation = FastConsultation(env, self.fast_lab, dataset, params, streams, tracer)
+        self.main_consultation = MainConsultation(env, self.main_lab, self.bed, dataset, params, streams, tracer)
+        self.triage = Triage(env, self.fast_consultation, self.main_consultation, params, streams, tracer)
+        # Stage and resource of every stage code
+        self.stages = {TRIAGE: self.triage, CONSULT_FAST: self.fast_consultation, CONSULT_MAIN: self.main_consultation,
+                       LAB_FAST: self.fast_lab, LAB_MAIN: self.main_lab, BED: self.bed}
+        self.resources = {TRIAGE: self.triage.triage_resource,
+                          CONSULT_FAST: self.fast_consultation.consultation_resource,
+                          CONSULT_MAIN: self.main_consultation.consultation_resource,
+                          LAB_FAST: self.fast_lab.lab_resource, LAB_MAIN: self.main_lab.lab_resource,
+                          BED: self.bed.bed_resource}
+
+    def resume_patient(self, stage, patient, service_time=None, service_start=None):
+        """
+        Put a patient from a snapshot back in the stage with the given code
+        """
+        self.stages[stage].resume_patient(patient, service_time, service_start)
+
+def run_replication(params, run, trace=None, env=None, snapshot=None, sink=None, batch_size=4096, profiler=None):
+    """
+    Runs one replication and returns its Dataset
+
+    Params:
+    -------
+    params = simulation parameters
+    run = run id, seeds the random streams of the run
+    trace = optional TraceConfig
+    env = optional simpy environment to run in, unused by the kernel engine
+    snapshot = optional warmup.Snapshot to start from instead of an empty ED
+    sink = optional writer receiving the records in batches as patients leave, the
+           returned Dataset then only holds the statistics of the run
+    batch_size = records per batch written to the sink, arrivals are generated in
+                 chunks of the same size
+    profiler = optional profiling.Profiler timing the stages, variates and records of the run
+    """
+    if params.engine == 'kernel':
+        if env is not None:
+            raise ValueError("The kernel engine does not run in a simpy environment")
+        return run_kernel_replication(params, run, trace, snapshot, sink, batch_size, profiler)
+    if params.engine != 'simpy':
+        raise ValueError(f"Unknown engine {params.engine}, expected 'simpy' or 'kernel'")
+
+    # Every stage and patient of the run shares one immutable parameter set
+    params = params.frozen()
+    # Seed each run independently so results do not depend on which worker runs it
+    streams = replication_streams(params, run)
+    tracer = trace.open(run) if trace is not None else None
+
+    # Setting up the simulation
+    dataset = Dataset(params, run, sink=sink, batch_size=batch_size)
+    chunk_size = batch_size if sink is not None else None
+    if env is None:
+        initial_time = snapshot.time if snapshot is not None else 0
+        env = profiler.environment(initial_time) if profiler is not None else simpy.Environment(initial_time)
+    if profiler is not None:
+        profiler.instrument_streams(streams)
+        profiler.instrument_dataset(dataset)
+    warm_up = params.warm_up
+    sim_duration = params.sim_duration
+    ed = EmergencyDepartment(env, params, dataset, streams, tracer)
+    if snapshot is None:
+        env.process(patient_generator(env, params, ed.triage, streams, chunk_size=chunk_size))
+    else:
+        snapshot.restore(ed, params)
+        env.process(patient_generator(env, params, ed.triage, streams, snapshot.time, snapshot.next_p_id, chunk_size))
+
+    # Run the simulation
+    env.run(until=warm_up + sim_duration)
+    if tracer is not None:
+        tracer.close()
+    for stage, resource in ed.resources.items():
+        dataset.add_resource(STAGES[stage], resource.summary(warm_up + sim_duration), resource.series)
+    start = snapshot.time if snapshot is not None else 0
+    dataset.add_controls(streams.controls(expected_arrivals(params, start, warm_up + sim_duration, start == 0)))
+    dataset.finalise()
+    return dataset
+
+class StreamingReplication:
+    """
+    Picklable replicate function writing the records of every run from the
+    process running it, in batches as patients leave, so memory depends on the
+    patients in the ED rather than on the horizon. Each run is its own
+    partition of a parquet or feather output, see writers.ArrowWriter
+    """
+    def __init__(self, output, name, directory='data', batch_size=4096):
+        """
+        Params:
+        -------
+        output = 'parquet' or 'feather'
+        name = name of the scenario output in directory
+        directory = output directory
+        batch_size = records per batch written, see run_replication
+        """
+        if output == 'csv':
+            raise ValueError("Streamed runs are written concurrently, use output='parquet' or 'feather'")
+        self.output = output
+        self.name = name
+        self.directory = directory
+        self.batch_size = batch_size
+
+    def open(self):
+        return open_writer(self.output, self.name, self.directory, clear=False)
+
+    def __call__(self, params, run, trace=None):
+        writer = self.open()
+        dataset = run_replication(params, run, trace, sink=writer, batch_size=self.batch_size)
+        writer.close()
+        return dataset
+
+def map_replications(jobs, workers=1, trace=None, replicate=run_replication):
+    """
+    Yields the result of run_replication for each (params, run) job, in job order.
+
+    Params:
+    -------
+    jobs = iterable of (params, run) pairs, scenarios may differ between jobs
+    workers = number of worker processes, 1 runs everything in this process
+    trace = optional TraceConfig, every run writes its own trace file
+    replicate = module level function (or picklable callable) called as replicate(params, run, trace) for
+                every job, defaults to run_replication
+    """
+    if workers <= 1:
+        for params, run in jobs:
+            yield replicate(params, run, trace)
+        return
+
+    # Keep a bounded window of submitted runs so results can be consumed (and the
+    # generator closed) before the whole sweep has been scheduled
+    jobs = iter(jobs)
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        pending = deque()
+        try:
+            for params, run in jobs:
+                pending.append(executor.submit(replicate, params, run, trace))
+                if len(pending) >= 2 * workers:
+                    yield pending.popleft().result()
+            while pending:
+                yield pending.popleft().result()
+        finally:
+            for future in pending:
+                future.cancel()
+
+def iter_replications(params, runs, workers=1, trace=None, replicate=run_replication):
+    """
+    Yields the result of run_replication for each run of one scenario, in run order.
+    """
+    return map_replications(((params, run) for run in runs), workers, trace, replicate)
+
+def run_simulator(params, save_file_name, workers=1, trace=None, target_half_width=None, kpis=WAIT_KPIS, min_runs=10,
+                  output='csv', replicate=run_replication, stream=False, batch_size=4096, profile=None, controls=()):
+    """
+    Runs up to params.number_of_runs replications, writes every patient record as
+    the runs finish and returns the StreamingSummary of the runs
+
+    Params:
+    -------
+    params = simulation parameters
+    save_file_name = name of the scenario output in data/
+    workers = number of worker processes
+    trace = optional TraceConfig
+    target_half_width = stop early once the confidence interval of every KPI mean
+                        is this narrow, see StreamingSummary.converged
+    kpis = Dataset columns summarised and checked for early stopping
+    min_runs = number of replications run before early stopping is allowed
+    output = output format, see writers.open_writer
+    replicate = function running one replication, e.g. warmup.SnapshotReplication
+    stream = write the records from the workers in batches as patients leave, for long
+             horizons (parquet or feather output only, see StreamingReplication).
+             The quantiles of the summary are then estimated from a sample of every run
+    batch_size = records per batch written when streaming
+    profile = optional profiling.ProfileConfig, instruments the runs and collects their profile
+    controls = control variates narrowing the confidence intervals, see estimators.StreamingSummary
+    """
+    started = time.perf_counter()
     #Setup for current patient load
-    run_df_list = []
-    for run in range(params.number_of_runs):
-        # Setting up the simulation
-        dataset = Dataset(params)
-        env = simpy.Environment()
-        warm_up = params.warm_up
-        sim_duration = params.sim_duration
-        bed = BedAssignment(env, dataset, params)
-        fast_lab = FastLab(env, dataset, params)
-        main_lab = MainLab(env, bed, dataset, params)
-        fast_consultation = FastConsultation(env, fast_lab, dataset, params)
-        main_consultation = MainConsultation(env, main_lab, bed, dataset, params)
-        triage = Triage(env, fast_consultation, main_consultation, params)
-        env.process(patient_generator(env, params, triage))
-
-        # Run the simulation
-        env.run(until=warm_up + sim_duration)
-        curr_dataset = dataset.get_patients_df()
-        curr_dataset['run'] = [run]*len(curr_dataset)
-        run_df_list.append(curr_dataset)
-    full_data = pd.concat(run_df_list)
-    full_data.to_csv(f'data/{save_file_name}.csv', index=False)
+    if stream:
+        if replicate is not run_replication:
+            raise ValueError("Streaming runs plain replications, it cannot be combined with replicate")
+        replicate = StreamingReplication(output, save_file_name, batch_size=batch_size)
+        remove_output(save_file_name)
+        writer = None
+    else:
+        writer = open_writer(output, save_file_name)
+    if profile is not None:
+        if isinstance(replicate, StreamingReplication):
+            replicate = profile.replicate(replicate)
+        elif replicate is run_replication:
+            replicate = profile.replicate()
+        else:
+            raise ValueError("Profiling runs plain or streamed replications, it cannot be combined with replicate")
+    section = profile.main.section if profile is not None else lambda name: nullcontext()
+    summary = StreamingSummary(kpis, controls=controls)
+    replications = iter_replications(params, range(params.number_of_runs), workers, trace, replicate)
+    # Runs are consumed in run order, so the stopping point does not depend on workers
+    for dataset in replications:
+        if profile is not None:
+            profile.add_run(dataset)
+        if writer is not None:
+            with section('output'):
+                writer.write(dataset)
+        with section('summary'):
+            summary.update(dataset)
+        if target_half_width is not None and summary.converged(target_half_width, min_runs):
+            # Closing waits for the runs already started, whose streamed partitions the summary never counted
+            replications.close()
+            if stream:
+                remove_output(save_file_name, runs=range(summary.runs, params.number_of_runs))
+            break
+    if writer is not None:
+        with section('output'):
+            writer.close()
+    if profile is not None:
+        profile.wall += time.perf_counter() - started
+    return summary
 
 
 if __name__ == "__main__":
-    #Run with original settings
-    params = Params()
-    run_simulator(params, "simulated_ED_data_10min")
-    # Run with mean_interarrival of 9min
-    params = Params()
-    params.mean_interarrival = 9
-    run_simulator(params, "simulated_ED_data_9min")
-    # Run with number_triage increase to 2 with mean_interarrival of 9min
-    params = Params()
-    params.mean_interarrival = 9
-    params.number_triage = 2
-    run_simulator(params, "simulated_ED_data_9min_number_triage_2")
-    # Run with number_triage increase to 2 with mean_interarrival of 9min, with 3 main doctors, 2 beds
-    params = Params()
-    params.mean_interarrival = 9
-    params.number_triage = 2
-    params.number_docs_main = 3
-    params.number_nurses_main = 2
-    params.number_of_beds = 2
-    run_simulator(params, "simulated_ED_data_9min_full_optimised")
-    
-    
-
+    # Run the original scenarios, see cli.py for running other scenario files
+    from cli import main
+    main([os.path.join(os.path.dirname(os.path.abspath(__file__)), 'scenarios', 'default.json')])
@@ -0,0 +1,118 @@
+import simpy
+
+class Monitor:
+    """
+    Time-weighted busy servers and queue length of a station, updated in O(1)
+    per state change, with an optional downsampled time series
+    """
+    def __init__(self, now, capacity, start=0, sample_interval=None):
+        """
+        Params:
+        -------
+        now = simulation time the monitor starts at
+        capacity = number of servers
+        start = simulation time the integrals start from, e.g. the end of the warm-up
+        sample_interval = minutes between time series samples, None disables the series
+        """
+        self.capacity = capacity
+        self.start = start
+        self.last_time = now
+        self.last_busy = 0
+        self.last_queue = 0
+        self.busy_area = 0.0
+        self.queue_area = 0.0
+        self.max_queue = 0
+        self.sample_interval = sample_interval
+        self.next_sample = now
+        self.series = []
+
+    def advance(self, now):
+        """
+        Integrate the state held since the last observation up to now
+        """
+        if now <= self.last_time:
+            return
+        if self.sample_interval is not None:
+            # Sample points up to now saw the state held since the last observation
+            while self.next_sample < now:
+                self.series.append((self.next_sample, self.last_busy, self.last_queue))
+                self.next_sample += self.sample_interval
+        begin = max(self.last_time, self.start)
+        if now > begin:
+            self.busy_area += (now - begin) * self.last_busy
+            self.queue_area += (now - begin) * self.last_queue
+        self.last_time = now
+
+    def update(self, now, busy, queue):
+        """
+        Record the state of the station from now on
+        """
+        self.advance(now)
+        self.last_busy = busy
+        self.last_queue = queue
+        if queue > self.max_queue and now >= self.start:
+            self.max_queue = queue
+
+    def summary(self, until):
+        """
+        Returns the time-weighted statistics between start and until
+
+        Params:
+        -------
+        until = end of the observation window, usually the end of the run
+        """
+        self.advance(until)
+        duration = until - self.start
+        if duration <= 0:
+            return {'capacity': self.capacity, 'utilization': float('nan'), 'mean_busy': float('nan'),
+                    'mean_queue': float('nan'), 'max_queue': self.max_queue}
+        return {'capacity': self.capacity, 'utilization': self.busy_area / (duration * self.capacity),
+                'mean_busy': self.busy_area / duration, 'mean_queue': self.queue_area / duration,
+                'max_queue': self.max_queue}
+
+class Monitored:
+    """
+    Mixin for SimPy resources feeding a Monitor.
+
+    Every change of the users or the queue goes through _trigger_put or
+    _trigger_get, so observing after both keeps the integrals exact.
+    """
+    def __init__(self, env, capacity=1, start=0, sample_interval=None):
+        """
+        Params:
+        -------
+        env = simulation environment
+        capacity = number of servers
+        start = simulation time the integrals start from, e.g. the end of the warm-up
+        sample_interval = minutes between time series samples, None disables the series
+        """
+        super().__init__(env, capacity)
+        self.monitor = Monitor(env.now, capacity, start, sample_interval)
+
+    @property
+    def patients(self):
+        """
+        Number of patients at the stage, waiting or in service
+        """
+        return len(self.users) + len(self.put_queue)
+
+    @property
+    def series(self):
+        return self.monitor.series
+
+    def _trigger_put(self, get_event):
+        super()._trigger_put(get_event)
+        self.monitor.update(self._env.now, len(self.users), len(self.put_queue))
+
+    def _trigger_get(self, put_event):
+        super()._trigger_get(put_event)
+        self.monitor.update(self._env.now, len(self.users), len(self.put_queue))
+
+    def summary(self, until):
+        return self.monitor.summary(until)
+
+class MonitoredResource(Monitored, simpy.Resource):
+    pass
+
+class MonitoredPriorityResource(Monitored, simpy.PriorityResource):
+    pass
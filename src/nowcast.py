@@ -0,0 +1,425 @@
+"""
+Nowcast: forecast the waits of the next hours from the live state of the ED.
+
+The state lists the patients waiting and in service at every stage and the
+staff on shift. Every replication restores it as a warmup.Snapshot, drawing
+what the state does not say (residual service times given the time already
+spent in service, priorities and outcomes of patients not triaged yet), and
+runs the kernel engine forward for the horizon. Waits are recorded when
+services start, so patients still in the ED at the horizon count too, and
+patients still queued at the horizon count with the wait so far. The waits of
+every replication are pooled into quantiles per stage and priority.
+
+Replications run in batches on a pool of workers kept warm between requests,
+until the requested number is reached or the latency budget runs out.
+
+A state, as JSON:
+
+    {"clock": 870, "horizon": 240,
+     "params": {"number_triage": 2, "number_docs_main": 3},
+     "stages": {"triage": {"waiting": [{"waited": 12}, {"waited": 4}], "in_service": [{"elapsed": 3}]},
+                "consult_main": {"waiting": [{"priority": 2, "waited": 30, "lab": true}]},
+                "bed": {"in_service": [{"priority": 1, "elapsed": 95}]}}}
+
+clock = minutes since midnight, lining up Params.arrival_profile with the hour of day
+horizon = minutes forecast
+params = Params overrides, staffing on shift and arrival profile
+stages = patients of each stage of tracing.STAGES, 'waiting' in queue order with the
+         minutes waited at the stage, 'in_service' with the minutes in service. The
+         priority, lab and bed outcomes are drawn when left out
+
+Serve it as JSON lines on stdin/stdout or over HTTP (POST the state to /nowcast):
+
+    python nowcast.py --workers 4 < states.jsonl
+    python nowcast.py --http 8080 --replications 500 --budget 0.2
+"""
+import argparse
+import json
+import math
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from statistics import NormalDist
+import numpy as np
+from entities import Priority, TriageOutcome, LabOutcome
+from parameters import Params, check_overrides, is_number
+from utils import PRIORITY_LEVELS, PRIORITY_WEIGHTS, ExponentialStream, replication_seed, replication_streams
+from tracing import *
+from arrivals import arrival_chunks
+from dataset import Dataset
+from estimators import WAIT_KPIS
+from kernel import Kernel
+from warmup import Snapshot
+
+# Purpose code of the random streams completing the state, see utils.replication_seed
+NOWCAST_STREAMS = 2
+# Simulation time of midnight on the day of the state. A day in, so no arrival falls at time 0
+DAY = 24 * 60
+# Variates drawn per refill of the streams, a few hours need few of them
+BLOCK_SIZE = 64
+# Wait KPI of every stage
+STAGE_KPIS = {TRIAGE: 'triage_wait_time', CONSULT_FAST: 'consultation_wait_time',
+              CONSULT_MAIN: 'consultation_wait_time', LAB_FAST: 'lab_wait_time', LAB_MAIN: 'lab_wait_time',
+              BED: 'bed_wait_time'}
+
+def entry_time(stage, patient):
+    """
+    Returns the time a patient joined the queue of a stage
+    """
+    if stage == TRIAGE:
+        return patient.arrival_time
+    if stage == CONSULT_FAST or stage == CONSULT_MAIN:
+        return patient.finished_triage_time
+    if stage == LAB_FAST or stage == LAB_MAIN:
+        return patient.finished_consult_time
+    if patient.lab_outcome == LabOutcome.LAB:
+        return patient.finished_lab_time
+    return patient.finished_consult_time
+
+def residual_time(stream, elapsed, rng):
+    """
+    Returns a remaining service time of a patient elapsed minutes into their
+    service, drawn from the service time distribution beyond elapsed
+
+    Params:
+    -------
+    stream = service time stream of the stage, see RandomStreams.services
+    elapsed = minutes already in service
+    rng = numpy generator of the draw
+    """
+    if isinstance(stream, ExponentialStream):
+        # Exponential stays have no memory
+        return rng.exponential(stream.mean)
+    normal = NormalDist(stream.mu, stream.sigma)
+    # Invert the distribution above the time already spent, clamped away from 1 far in the tail
+    low = normal.cdf(math.log(elapsed)) if elapsed > 0 else 0.0
+    u = min(low + (1 - low) * rng.random(), 1 - 1e-12)
+    return max(math.exp(normal.inv_cdf(u)) - elapsed, 0.0)
+
+def patient_fields(stage, p_id, entry, fields, params, rng):
+    """
+    Returns the patient fields of a patient of the state who joined a stage at
+    entry, drawing the priority and outcomes left out
+
+    Params:
+    -------
+    stage = stage code of the patient
+    p_id = patient id
+    entry = simulation time the patient joined the queue of the stage
+    fields = patient of the state, see the module docstring
+    params = simulation parameters
+    rng = numpy generator completing the state
+    """
+    # Stages seeing FAST (priority 3 to 5) or MAIN (1 and 2) patients only, see Patient.set_outcome
+    levels = PRIORITY_LEVELS
+    if stage in (CONSULT_FAST, LAB_FAST):
+        levels = [level for level in PRIORITY_LEVELS if level >= 3]
+    elif stage == BED:
+        levels = [level for level in PRIORITY_LEVELS if level < 3]
+    priority = fields.get('priority')
+    if priority is None:
+        weights = np.cumsum([PRIORITY_WEIGHTS[PRIORITY_LEVELS.index(level)] for level in levels])
+        priority = levels[int(np.searchsorted(weights, rng.random() * weights[-1], side='right'))]
+    if priority not in levels:
+        raise ValueError(f"Patients at {STAGES[stage]} have a priority in {levels}, got {priority}")
+    priority = Priority(priority)
+    triage_outcome = TriageOutcome.MAIN if priority < 3 else TriageOutcome.FAST
+
+    lab = fields.get('lab')
+    if lab is None:
+        if stage in (LAB_FAST, LAB_MAIN):
+            lab = True
+        else:
+            lab = rng.random() < (params.p_main_lab if triage_outcome == TriageOutcome.MAIN else params.p_fast_lab)
+    bed = fields.get('bed')
+    if bed is None:
+        bed = stage == BED or (triage_outcome == TriageOutcome.MAIN and rng.random() < params.p_ed)
+
+    patient = {'p_id': p_id, 'arrival_time': entry, 'priority': priority, 'triage_outcome': triage_outcome,
+               'lab_outcome': LabOutcome.LAB if lab else LabOutcome.NO_LAB, 'bed_outcome': bool(bed and priority < 3)}
+    # Times the patient finished the previous stages, only the one leading to this stage is known
+    if stage in (CONSULT_FAST, CONSULT_MAIN):
+        patient['finished_triage_time'] = entry
+    elif stage in (LAB_FAST, LAB_MAIN):
+        patient['finished_consult_time'] = entry
+    elif stage == BED:
+        patient['finished_lab_time' if patient['lab_outcome'] == LabOutcome.LAB else 'finished_consult_time'] = entry
+    return patient
+
+def forecast_params(state):
+    """
+    Returns the frozen Params of the replications of a state, the snapshot
+    taken at the end of the warm-up and the horizon as sim_duration
+    """
+    overrides = state.get('params', {})
+    if not isinstance(overrides, dict):
+        raise ValueError("params expects an object of Params overrides")
+    check_overrides(overrides)
+    for name in ('clock', 'horizon'):
+        if name in state and not (is_number(state[name]) and state[name] >= 0):
+            raise ValueError(f"{name} must be a non-negative number of minutes, got {state[name]!r}")
+    params = Params(**{**overrides, 'warm_up': DAY + state.get('clock', 0),
+                       'sim_duration': state.get('horizon', 240), 'start_hour': 0, 'engine': 'kernel'})
+    return params.frozen()
+
+def minutes(fields, name, stage):
+    """
+    Returns a duration field of a patient, 0 when left out
+    """
+    value = fields.get(name, 0)
+    if not isinstance(value, (int, float)) or isinstance(value, bool) or not value >= 0:
+        raise ValueError(f"{name} of patients at {STAGES[stage]} must be a non-negative number of minutes, got {value!r}")
+    return value
+
+def state_snapshot(state, params, run, streams):
+    """
+    Returns the Snapshot of a state for one replication, with its own draws of
+    what the state leaves out
+
+    Params:
+    -------
+    state = live state of the ED, see the module docstring
+    params = Params of the replication, see forecast_params
+    run = run id of the replication
+    streams = RandomStreams of the replication
+    """
+    unknown = set(state.get('stages', {})) - set(STAGES)
+    if unknown:
+        raise ValueError(f"Unknown stages {sorted(unknown)}, expected some of {STAGES}")
+    rng = np.random.default_rng(replication_seed(params.random_seed, run, NOWCAST_STREAMS))
+    now = params.warm_up
+    stages = {}
+    p_id = 1
+    for name, patients in state.get('stages', {}).items():
+        stage = STAGES.index(name)
+        if not isinstance(patients, dict):
+            raise ValueError(f"Stage {name} expects an object of 'waiting' and 'in_service' patients")
+        in_service = []
+        for fields in patients.get('in_service', []):
+            elapsed = minutes(fields, 'elapsed', stage)
+            service_start = now - elapsed
+            patient = patient_fields(stage, p_id, service_start - minutes(fields, 'waited', stage), fields, params, rng)
+            in_service.append((patient, residual_time(streams.services[stage], elapsed, rng), service_start))
+            p_id += 1
+        waiting = []
+        # Longest waits first, the queue order of a FIFO stage
+        for fields in sorted(patients.get('waiting', []), key=lambda fields: -minutes(fields, 'waited', stage)):
+            waiting.append(patient_fields(stage, p_id, now - minutes(fields, 'waited', stage), fields, params, rng))
+            p_id += 1
+        stages[stage] = (in_service, waiting)
+    return Snapshot(now, p_id, stages)
+
+class ForecastKernel(Kernel):
+    """
+    Kernel recording the wait of every service starting after the snapshot
+    """
+    def __init__(self, params, dataset, streams, now):
+        super().__init__(params, dataset, streams, now=now)
+        # (stage, priority, wait) of every service started
+        self.waits = []
+
+    def start(self, station, patient):
+        # Patients resumed in service waited before the snapshot
+        if patient.p_id not in self.resumed:
+            self.waits.append((station.stage, patient.priority, self.now - entry_time(station.stage, patient)))
+        super().start(station, patient)
+
+    def queued(self, until):
+        """
+        Returns the (stage, priority, wait so far) of the patients still queued at until
+        """
+        waits = []
+        for station in self.stations:
+            patients = [item[3] for item in station.queue] if station.ordered else station.queue
+            waits.extend((station.stage, patient.priority, until - entry_time(station.stage, patient))
+                         for patient in patients)
+        return waits
+
+def forecast_replication(state, params, run):
+    """
+    Runs one replication forward from the state and returns the (stage,
+    priority, wait) of every service started within the horizon and of the
+    patients still queued at its end
+    """
+    streams = replication_streams(params, run, BLOCK_SIZE)
+    snapshot = state_snapshot(state, params, run, streams)
+    until = params.warm_up + params.sim_duration
+    kernel = ForecastKernel(params, Dataset(params, run), streams, snapshot.time)
+    snapshot.restore(kernel, params)
+    chunks = arrival_chunks(params, streams.arrivals, streams.thinning, until, snapshot.time, include_start=False)
+    kernel.run((time for chunk in chunks for time in chunk.tolist()), until, snapshot.next_p_id)
+    return kernel.waits + kernel.queued(until)
+
+def forecast_batch(state, params, runs):
+    """
+    Returns the waits of a batch of replications as an (n, 3) array, see forecast_replication
+    """
+    waits = [wait for run in runs for wait in forecast_replication(state, params, run)]
+    return np.array(waits, dtype=float).reshape(-1, 3)
+
+def summarise(waits, replications, quantiles):
+    """
+    Returns the wait quantiles of every KPI, over every priority and by priority
+    """
+    summary = {}
+    kpis = np.array([WAIT_KPIS.index(STAGE_KPIS[stage]) for stage in range(len(STAGES))])
+    kpi_codes = kpis[waits[:, 0].astype(int)] if len(waits) else np.empty(0, dtype=int)
+    for code, kpi in enumerate(WAIT_KPIS):
+        selected = waits[kpi_codes == code]
+        groups = {'all': selected[:, 2]}
+        groups.update({str(level): selected[selected[:, 1] == level, 2] for level in PRIORITY_LEVELS})
+        summary[kpi] = {}
+        for group, values in groups.items():
+            result = {'patients': len(values) / replications if replications else 0.0,
+                      'mean': float(values.mean()) if len(values) else None}
+            for p in quantiles:
+                result[f"p{round(p * 100)}"] = float(np.quantile(values, p)) if len(values) else None
+            summary[kpi][group] = result
+    return summary
+
+class Nowcaster:
+    """
+    Forecasts waits from live states, on a pool of workers kept between requests
+    """
+    def __init__(self, workers=1, replications=500, budget=0.2, batch_size=25, quantiles=(0.5, 0.9)):
+        """
+        Params:
+        -------
+        workers = number of worker processes, 1 runs the replications in this process
+        replications = replications run per forecast
+        budget = seconds a forecast may take, it returns the replications done by then
+        batch_size = replications per task handed to a worker
+        quantiles = wait quantiles reported
+        """
+        self.workers = workers
+        self.replications = replications
+        self.budget = budget
+        self.batch_size = batch_size
+        self.quantiles = quantiles
+        self.executor = ProcessPoolExecutor(max_workers=workers) if workers > 1 else None
+        if self.executor is not None:
+            # Start the workers and import the model in them before the first request
+            warm = {'horizon': 1, 'stages': {}}
+            list(self.executor.map(forecast_batch, [warm] * workers, [forecast_params(warm)] * workers,
+                                   [[0]] * workers))
+
+    def forecast(self, state):
+        """
+        Returns the forecast of a state, see the module docstring. The state may
+        override 'replications', 'budget' and 'quantiles' of the nowcaster
+        """
+        started = time.perf_counter()
+        replications = state.get('replications', self.replications)
+        budget = state.get('budget', self.budget)
+        quantiles = state.get('quantiles', self.quantiles)
+        deadline = started + budget if budget is not None else math.inf
+        params = forecast_params(state)
+        # Fail on an invalid state here rather than in the workers
+        state_snapshot(state, params, 0, replication_streams(params, 0))
+
+        batches = [range(first, min(first + self.batch_size, replications))
+                   for first in range(0, replications, self.batch_size)]
+        results = []
+        done = 0
+        if self.executor is None:
+            for runs in batches:
+                if time.perf_counter() >= deadline and done:
+                    break
+                results.append(forecast_batch(state, params, runs))
+                done += len(runs)
+        else:
+            futures = {self.executor.submit(forecast_batch, state, params, runs): len(runs) for runs in batches}
+            pending = set(futures)
+            while pending:
+                # Wait for a first batch whatever the budget
+                timeout = max(deadline - time.perf_counter(), 0) if done and budget is not None else None
+                finished, pending = wait(pending, timeout=timeout, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    results.append(future.result())
+                    done += futures[future]
+                if not finished:
+                    break
+            for future in pending:
+                future.cancel()
+
+        waits = np.concatenate(results) if results else np.empty((0, 3))
+        return {'replications': done, 'seconds': time.perf_counter() - started, 'clock': state.get('clock', 0),
+                'horizon': params.sim_duration, 'waits': summarise(waits, done, quantiles)}
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown(cancel_futures=True)
+
+def answer(nowcaster, text):
+    """
+    Returns the JSON forecast of a JSON state, or a JSON error
+    """
+    try:
+        state = json.loads(text)
+        if not isinstance(state, dict):
+            raise ValueError("expected a JSON object")
+        return json.dumps(nowcaster.forecast(state))
+    except (ValueError, TypeError, AttributeError) as error:
+        return json.dumps({'error': str(error)})
+    except Exception as error:
+        # A failed simulation, e.g. in a worker, answers this state only and keeps the service up
+        return json.dumps({'error': f"forecast failed: {type(error).__name__}: {error}"})
+
+def serve_lines(nowcaster, lines=None, output=None):
+    """
+    Answers every state read as a JSON line with its forecast as a JSON line,
+    from stdin to stdout by default
+    """
+    lines = lines if lines is not None else sys.stdin
+    output = output if output is not None else sys.stdout
+    for line in lines:
+        if line.strip():
+            output.write(answer(nowcaster, line) + '\n')
+            output.flush()
+
+def serve_http(nowcaster, port, host='127.0.0.1'):
+    """
+    Answers the states POSTed to /nowcast with their forecast
+    """
+    class Handler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            if self.path != '/nowcast':
+                self.send_error(404)
+                return
+            body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+            reply = answer(nowcaster, body).encode()
+            self.send_response(400 if reply.startswith(b'{"error"') else 200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(reply)))
+            self.end_headers()
+            self.wfile.write(reply)
+
+    server = HTTPServer((host, port), Handler)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--http', type=int, metavar='PORT', help="serve over HTTP instead of stdin/stdout")
+    parser.add_argument('--host', default='127.0.0.1', help="address the HTTP server listens on")
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help="number of worker processes")
+    parser.add_argument('--replications', type=int, default=500, help="replications per forecast")
+    parser.add_argument('--budget', type=float, default=0.2, help="seconds a forecast may take")
+    args = parser.parse_args(argv)
+    nowcaster = Nowcaster(args.workers, args.replications, args.budget)
+    try:
+        if args.http is not None:
+            serve_http(nowcaster, args.http, args.host)
+        else:
+            serve_lines(nowcaster)
+    finally:
+        nowcaster.close()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,130 @@
+"""
+Staffing optimisation by successive halving.
+
+Every staffing configuration within the budget starts with a few
+replications, then each round keeps the best 1/eta of the configurations and
+gives the survivors eta times more replications. All configurations reuse the
+same run ids, hence the same arrival and service streams (common random
+numbers), which sharpens the comparison between them.
+"""
+import itertools
+import math
+import os
+from parameters import Params
+from main import map_replications
+from estimators import RunningStat
+from screening import shortlist
+
+# Staffing parameters searched by the optimiser
+STAFFING = ['number_triage', 'number_docs_fast', 'number_docs_main', 'number_nurses_fast', 'number_nurses_main',
+            'number_of_beds']
+# Cost of one unit of each resource, used against the budget
+DEFAULT_COSTS = {name: 1 for name in STAFFING}
+# Weight of each KPI in the objective, the weighted sum of mean waits in minutes
+DEFAULT_WEIGHTS = {'triage_wait_time': 1, 'consultation_wait_time': 1, 'lab_wait_time': 1, 'bed_wait_time': 1}
+
+def staffing_cost(overrides, costs=DEFAULT_COSTS, base_params=None):
+    """
+    Returns the cost of a staffing configuration
+    """
+    params = base_params if base_params is not None else Params()
+    return sum(cost * overrides.get(name, getattr(params, name)) for name, cost in costs.items())
+
+def staffing_space(bounds, budget=None, costs=DEFAULT_COSTS, base_params=None):
+    """
+    Returns every staffing configuration within the bounds and the budget
+
+    Params:
+    -------
+    bounds = staffing parameter mapped to its (min, max) number of units,
+             parameters left out keep their base value
+    budget = maximum cost of a configuration, None for no limit
+    costs = cost of one unit of each staffing parameter
+    base_params = Params the configurations are applied on
+    """
+    names = list(bounds)
+    ranges = [range(low, high + 1) for low, high in bounds.values()]
+    space = []
+    for values in itertools.product(*ranges):
+        overrides = dict(zip(names, values))
+        if budget is None or staffing_cost(overrides, costs, base_params) <= budget:
+            space.append(overrides)
+    return space
+
+def run_objective(dataset, weights):
+    """
+    Returns the objective of one replication, the weighted sum of its mean waits
+    """
+    total = 0.0
+    for kpi, weight in weights.items():
+        mean = dataset.mean(kpi)
+        if not math.isnan(mean):
+            total += weight * mean
+    return total
+
+def successive_halving(candidates, base_params=None, workers=1, initial_runs=5, eta=2, max_runs=None,
+                       weights=DEFAULT_WEIGHTS, costs=DEFAULT_COSTS, verbose=True):
+    """
+    Returns the candidates ranked by objective, best first, after successive halving
+
+    Params:
+    -------
+    candidates = list of staffing overrides, e.g. from staffing_space
+    base_params = Params the overrides are applied on, defaults to Params()
+    workers = number of worker processes evaluating replications
+    initial_runs = replications given to every candidate in the first round
+    eta = fraction of candidates kept per round is 1/eta, survivors get eta times more runs
+    max_runs = replication cap of a candidate, defaults to base_params.number_of_runs
+    weights = weight of each KPI in the objective
+    costs = cost of one unit of each staffing parameter
+
+    Returns:
+    -------
+    (list) dicts of overrides, cost, runs, objective and its 95% half-width, empty without candidates
+    """
+    if not candidates:
+        return []
+    base = base_params.overrides() if base_params is not None else {}
+    max_runs = max_runs if max_runs is not None else Params(**base).number_of_runs
+    stats = [RunningStat() for _ in candidates]
+    alive = list(range(len(candidates)))
+    runs_done = 0
+    runs_target = min(initial_runs, max_runs)
+
+    while True:
+        # Give every surviving candidate the replications it is missing
+        jobs = [(index, Params(**{**base, **candidates[index]}), run)
+                for index in alive for run in range(runs_done, runs_target)]
+        results = map_replications(((params, run) for _, params, run in jobs), workers)
+        for (index, _, _), dataset in zip(jobs, results):
+            stats[index].update(run_objective(dataset, weights))
+        runs_done = runs_target
+
+        alive.sort(key=lambda index: stats[index].mean)
+        if verbose:
+            best = alive[0]
+            print(f"{len(alive)} candidates at {runs_done} runs, best {candidates[best]} "
+                  f"objective {stats[best].mean:.2f}")
+        if len(alive) == 1 or runs_done >= max_runs:
+            break
+        alive = alive[:max(1, math.ceil(len(alive) / eta))]
+        runs_target = min(runs_done * eta, max_runs)
+
+    # Candidates dropped in later rounds rank above those dropped earlier
+    ranked = sorted(range(len(candidates)), key=lambda index: (-stats[index].n, stats[index].mean))
+    return [{'overrides': candidates[index], 'cost': staffing_cost(candidates[index], costs, Params(**base)),
+             'runs': stats[index].n, 'objective': stats[index].mean, 'half_width': stats[index].half_width()}
+            for index in ranked]
+
+if __name__ == "__main__":
+    # Search the staffing of the 9 minute interarrival scenario with at most 10 staff and beds
+    base_params = Params(mean_interarrival=9)
+    bounds = {name: (1, 3) for name in STAFFING}
+    candidates = staffing_space(bounds, budget=10, base_params=base_params)
+    # Only simulate the configurations the analytical screen finds stable and most promising
+    candidates = shortlist(candidates, base_params, size=32)
+    if not candidates:
+        print("No staffing within the budget passed the analytical screen, raise the budget or the bounds")
+    ranking = successive_halving(candidates, base_params, workers=os.cpu_count())
+    for result in ranking[:5]:
+        print(result)
@@ -5,6 +5,18 @@ class Params:
     warm_up = 120
     sim_duration = 480
     number_of_runs = 250
+    # Base seed, each run derives its own seed from it
+    random_seed = 42
+    # Minutes between resource utilization / queue length samples, None keeps only the summary
+    monitor_interval = None
+    # Simulation engine, 'simpy' or 'kernel' (see kernel.py), both give the same results
+    engine = 'simpy'
+    # Draw every service time of a patient on arrival rather than as each service starts, so
+    # scenarios compared with the same seed see the same demands (common random numbers)
+    common_random_numbers = False
+    # Pair runs 2k and 2k+1, the second mirroring the variates of the first (antithetic variates).
+    # Use an even number_of_runs, see estimators.StreamingSummary for the pairing of estimates
+    antithetic = False
 
     """
     Deterministic parameters
@@ -21,6 +33,11 @@ class Params:
     """
     # Patient interarrival time (exponential distribution)
     mean_interarrival = 10
+    # Optional hour of day profile, relative arrival rate of each hour (e.g. 24 values averaging 1),
+    # arrivals then follow a non-homogeneous Poisson process. None keeps a constant rate
+    arrival_profile = None
+    # Hour of day at simulation time 0, used with arrival_profile
+    start_hour = 0
     # Patient time taken at triage (lognormal distribution)
     mean_triage = 10
     stdev_triage = 3
@@ -43,4 +60,97 @@ class Params:
     # Patient probability to remain in ED (binomial distribution)
     p_ed = 0.2
     # Patient stay for bed (exponential distribution)
-    mean_bed_time = 120
\ No newline at end of file
+    mean_bed_time = 120
+
+    def __init__(self, **overrides):
+        """
+        Params:
+        -------
+        overrides = parameter values replacing the class defaults
+        """
+        for name, value in overrides.items():
+            setattr(self, name, value)
+
+    def __setattr__(self, name, value):
+        if self.__dict__.get('_frozen', False):
+            raise AttributeError(f"Cannot set {name}, parameters are frozen")
+        if not hasattr(type(self), name):
+            raise AttributeError(f"Unknown parameter {name}")
+        super().__setattr__(name, value)
+
+    def overrides(self):
+        """
+        Returns the parameters that differ from the class defaults
+        """
+        return {name: value for name, value in vars(self).items() if name != '_frozen'}
+
+    def as_dict(self):
+        """
+        Returns every parameter value, defaults included
+        """
+        return {name: getattr(self, name) for name in dir(type(self))
+                if not name.startswith('_') and not callable(getattr(type(self), name))}
+
+    def frozen(self):
+        """
+        Returns an immutable copy of the parameters
+        """
+        params = Params(**self.overrides())
+        params.__dict__['_frozen'] = True
+        return params
+
+# Type of the values of the parameters whose class default is None
+OPTIONAL_TYPES = {'monitor_interval': float, 'arrival_profile': list}
+# Parameters counting things, which take whole numbers only
+COUNTS = {'number_of_runs', 'random_seed', 'number_triage', 'number_docs_fast', 'number_nurses_fast',
+          'number_docs_main', 'number_nurses_main', 'number_of_beds'}
+TYPE_NAMES = {bool: 'true or false', int: 'a whole number', float: 'a number', list: 'a list of numbers',
+              str: 'a string'}
+
+def is_number(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+def check_type(name, value):
+    """
+    Raises ValueError unless the value of a parameter has the type of its class default,
+    any number replacing a non-count number and None an optional parameter
+    """
+    default = getattr(Params, name)
+    expected = OPTIONAL_TYPES.get(name, str) if default is None else type(default)
+    if expected is int and name not in COUNTS:
+        expected = float
+    if default is None and value is None:
+        return
+    if expected is bool:
+        valid = isinstance(value, bool)
+    elif expected is int:
+        valid = isinstance(value, int) and not isinstance(value, bool)
+    elif expected is float:
+        valid = is_number(value)
+    elif expected is list:
+        valid = isinstance(value, list) and all(is_number(item) for item in value)
+    else:
+        valid = isinstance(value, expected)
+    if not valid:
+        expected = TYPE_NAMES[expected] + (' or null' if default is None else '')
+        raise ValueError(f"{name} must be {expected}, got {value!r}")
+
+def check_overrides(overrides):
+    """
+    Raises ValueError unless every override names a parameter, has the type of
+    its default (see check_type) and a value the simulation can run with
+
+    Params:
+    -------
+    overrides = dict of parameter name to value, e.g. from a scenario file
+    """
+    for name, value in overrides.items():
+        if name.startswith('_') or not hasattr(Params, name) or callable(getattr(Params, name)):
+            raise ValueError(f"Unknown parameter {name}")
+        check_type(name, value)
+    if overrides.get('mean_interarrival', Params.mean_interarrival) <= 0:
+        raise ValueError(f"mean_interarrival must be positive, got {overrides['mean_interarrival']!r}")
+    profile = overrides.get('arrival_profile')
+    if profile is not None and (min(profile, default=0) < 0 or max(profile, default=0) <= 0):
+        raise ValueError(f"arrival_profile must hold non-negative rates, at least one positive, got {profile!r}")
+
@@ -0,0 +1,335 @@
+"""
+Profiling of simulation runs.
+
+run_simulator(..., profile=ProfileConfig()) instruments every replication
+and collects, across workers, the wall-clock time and call count of:
+- each SimPy process (Triage.attend_patient, the consultation, lab and bed
+  processes and patient_generator), counted per resume, i.e. per event handled
+- the SimPy event loop itself, excluding the processes it resumes
+- with the kernel engine, the start and finish of service at each stage
+- random variate generation, record collection (Dataset), output writing,
+  summary updates and anything written to stdout
+Times are exclusive: a variate drawn inside a process counts as variates only.
+
+With cprofile=True every worker also keeps a cProfile of the runs it executes,
+and the report merges them with pstats:
+
+    config = ProfileConfig('data/profile', cprofile=True)
+    run_simulator(params, 'scenario', workers=4, profile=config)
+    print(config.report())
+"""
+import cProfile
+import glob
+import io
+import os
+import pstats
+import sys
+import time
+import uuid
+from collections import defaultdict
+from contextlib import contextmanager
+import numpy as np
+import simpy
+from utils import VariateStream, AntitheticGenerator
+from tracing import STAGES
+from main import run_replication
+
+# Dataset methods timed as record collection
+DATASET_METHODS = ('add_patient', 'add_resource', 'finalise')
+
+class Profiler:
+    """
+    Exclusive wall-clock time and call count of named sections
+    """
+    def __init__(self):
+        self.seconds = defaultdict(float)
+        self.calls = defaultdict(int)
+        self.stack = []
+        self.mark = None
+
+    def enter(self, name):
+        now = time.perf_counter()
+        if self.stack:
+            self.seconds[self.stack[-1]] += now - self.mark
+        self.stack.append(name)
+        self.calls[name] += 1
+        self.mark = now
+
+    def exit(self):
+        now = time.perf_counter()
+        self.seconds[self.stack.pop()] += now - self.mark
+        self.mark = now
+
+    @contextmanager
+    def section(self, name):
+        self.enter(name)
+        try:
+            yield
+        finally:
+            self.exit()
+
+    def wrap(self, name, function):
+        """
+        Returns function timed as the given section
+        """
+        def timed(*args, **kwargs):
+            self.enter(name)
+            try:
+                return function(*args, **kwargs)
+            finally:
+                self.exit()
+        return timed
+
+    def process(self, generator):
+        """
+        Returns a generator driving a SimPy process generator, timing each of
+        its resumes as a section named after the process function
+        """
+        name = generator.__qualname__
+        value, error = None, None
+        while True:
+            self.enter(name)
+            try:
+                event = generator.throw(error) if error is not None else generator.send(value)
+            except StopIteration as stop:
+                return stop.value
+            finally:
+                self.exit()
+            value, error = None, None
+            try:
+                value = yield event
+            except BaseException as exception:
+                error = exception
+
+    def environment(self, initial_time=0):
+        return ProfiledEnvironment(self, initial_time)
+
+    def instrument_streams(self, streams):
+        """
+        Time every variate drawn from the random streams of a run
+        """
+        for name, stream in vars(streams).items():
+            if isinstance(stream, VariateStream):
+                stream.sample = self.wrap('variates', stream.sample)
+            elif isinstance(stream, (np.random.Generator, AntitheticGenerator)):
+                setattr(streams, name, TimedGenerator(stream, self))
+
+    def instrument_dataset(self, dataset):
+        """
+        Time record collection, and writing when the dataset flushes to a sink
+        """
+        for name in DATASET_METHODS:
+            setattr(dataset, name, self.wrap('dataset', getattr(dataset, name)))
+        if dataset.sink is not None:
+            dataset.sink.write = self.wrap('output', dataset.sink.write)
+
+    def instrument_kernel(self, kernel):
+        """
+        Time the start and finish of service at every stage of a kernel.Kernel
+        """
+        start, finish = kernel.start, kernel.finish
+        def timed(method, event):
+            def stage(station, patient):
+                self.enter(f"Kernel.{event}[{STAGES[station.stage]}]")
+                try:
+                    return method(station, patient)
+                finally:
+                    self.exit()
+            return stage
+        kernel.start = timed(start, 'start')
+        kernel.finish = timed(finish, 'finish')
+        kernel.run = self.wrap('kernel loop', kernel.run)
+
+    @contextmanager
+    def stdout(self):
+        """
+        Time everything written to stdout within the block
+        """
+        original = sys.stdout
+        sys.stdout = TimedStream(original, self)
+        try:
+            yield
+        finally:
+            sys.stdout = original
+
+    def as_dict(self):
+        return {name: (self.seconds[name], self.calls[name]) for name in self.calls}
+
+    def add(self, sections):
+        """
+        Add the sections of another profile, e.g. of a run from a worker
+        """
+        for name, (seconds, calls) in sections.items():
+            self.seconds[name] += seconds
+            self.calls[name] += calls
+
+class ProfiledEnvironment(simpy.Environment):
+    """
+    SimPy environment timing its event loop and the processes it resumes
+    """
+    def __init__(self, profiler, initial_time=0):
+        super().__init__(initial_time)
+        self.profiler = profiler
+
+    def process(self, generator):
+        return super().process(self.profiler.process(generator))
+
+    def step(self):
+        self.profiler.enter('simpy')
+        try:
+            super().step()
+        finally:
+            self.profiler.exit()
+
+class TimedGenerator:
+    """
+    Proxy of a numpy generator timing every draw as variates
+    """
+    def __init__(self, rng, profiler):
+        self.rng = rng
+        self.profiler = profiler
+
+    def __getattr__(self, name):
+        attribute = getattr(self.rng, name)
+        return self.profiler.wrap('variates', attribute) if callable(attribute) else attribute
+
+class TimedStream:
+    """
+    Proxy of a text stream timing every write as stdout
+    """
+    def __init__(self, stream, profiler):
+        self.stream = stream
+        self.profiler = profiler
+
+    def write(self, text):
+        with self.profiler.section('stdout'):
+            return self.stream.write(text)
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
+# cProfile of the runs executed by this worker process for the ProfileConfig of worker_token,
+# replaced when a run of another ProfileConfig arrives
+worker_cprofile = None
+worker_token = None
+
+class ProfiledReplication:
+    """
+    Picklable replicate function running an instrumented run_replication and
+    returning its Dataset with the sections of the run as dataset.profile
+    """
+    def __init__(self, directory=None, stream=None, token=None):
+        """
+        Params:
+        -------
+        directory = where every worker dumps its cProfile, None disables cProfile
+        stream = optional main.StreamingReplication whose output the runs are streamed to
+        token = identifies the ProfileConfig, the runs of each one get their own cProfile
+        """
+        self.directory = directory
+        self.stream = stream
+        self.token = token
+
+    def __call__(self, params, run, trace=None):
+        global worker_cprofile, worker_token
+        profiler = Profiler()
+        if self.directory is not None:
+            if worker_cprofile is None or worker_token != self.token:
+                worker_cprofile = cProfile.Profile()
+                worker_token = self.token
+            worker_cprofile.enable()
+        started = time.perf_counter()
+        with profiler.stdout():
+            if self.stream is None:
+                dataset = run_replication(params, run, trace, profiler=profiler)
+            else:
+                writer = self.stream.open()
+                dataset = run_replication(params, run, trace, sink=writer, batch_size=self.stream.batch_size,
+                                          profiler=profiler)
+                with profiler.section('output'):
+                    writer.close()
+        wall = time.perf_counter() - started
+        if self.directory is not None:
+            worker_cprofile.disable()
+            # Overwritten after every run, the last dump holds every run of the worker
+            worker_cprofile.dump_stats(os.path.join(self.directory, f"worker_{os.getpid()}.prof"))
+        # Drop the timed methods so the dataset pickles back to the main process
+        for name in DATASET_METHODS:
+            vars(dataset).pop(name, None)
+        dataset.profile = {'wall': wall, 'sections': profiler.as_dict()}
+        return dataset
+
+class ProfileConfig:
+    """
+    Profiling settings of run_simulator, collecting the profile of its runs
+    """
+    def __init__(self, directory='data/profile', cprofile=False):
+        """
+        Params:
+        -------
+        directory = where the workers dump their cProfile, previous dumps are removed
+        cprofile = also run every replication under cProfile
+        """
+        self.directory = directory
+        self.cprofile = cprofile
+        self.token = uuid.uuid4().hex
+        if cprofile:
+            os.makedirs(directory, exist_ok=True)
+            for path in glob.glob(os.path.join(directory, 'worker_*.prof')):
+                os.remove(path)
+        self.runs = 0
+        self.replication_seconds = 0.0
+        self.wall = 0.0
+        # Sections of the replications, summed over the workers, and of the main process
+        self.profiler = Profiler()
+        self.main = Profiler()
+
+    def replicate(self, stream=None):
+        """
+        Returns the replicate function of the profiled runs
+        """
+        return ProfiledReplication(self.directory if self.cprofile else None, stream, self.token)
+
+    def add_run(self, dataset):
+        self.runs += 1
+        self.replication_seconds += dataset.profile['wall']
+        self.profiler.add(dataset.profile['sections'])
+
+    def cprofile_stats(self):
+        """
+        Returns the cProfile dumps of every worker merged into one pstats.Stats
+        """
+        paths = sorted(glob.glob(os.path.join(self.directory, 'worker_*.prof'))) if self.cprofile else []
+        if not paths:
+            return None
+        stats = pstats.Stats(paths[0], stream=io.StringIO())
+        for path in paths[1:]:
+            stats.add(path)
+        return stats
+
+    def report(self, top=25):
+        """
+        Returns the profile as text: the sections by exclusive time, then the
+        top functions of the merged cProfile when it was enabled
+        """
+        rows = sorted(((name, calls, self.profiler.seconds[name]) for name, calls in self.profiler.calls.items()),
+                      key=lambda row: -row[2])
+        # Replication time not attributed to a section, e.g. building the stages
+        other = self.replication_seconds - sum(seconds for _, _, seconds in rows)
+        rows.append(('other', '', max(other, 0.0)))
+        rows += [(f"{name} (main process)", calls, self.main.seconds[name]) for name, calls in self.main.calls.items()]
+        total = sum(seconds for _, _, seconds in rows) or 1.0
+        lines = [f"{self.runs} runs in {self.wall:.2f}s wall, {self.replication_seconds:.2f}s inside replications",
+                 f"{'section':<40}{'calls':>12}{'seconds':>12}{'share':>8}"]
+        for name, calls, seconds in rows:
+            lines.append(f"{name:<40}{calls:>12}{seconds:>12.3f}{seconds / total:>8.1%}")
+
+        stats = self.cprofile_stats()
+        if stats is not None:
+            merged = os.path.join(self.directory, 'merged.prof')
+            stats.dump_stats(merged)
+            text = io.StringIO()
+            stats.stream = text
+            stats.strip_dirs().sort_stats('cumulative').print_stats(top)
+            lines += ['', f"cProfile of every worker merged into {merged}:", text.getvalue()]
+        return '\n'.join(lines)
@@ -0,0 +1,271 @@
+"""
+Analytical screening of scenarios before simulating them.
+
+The ED is approximated as a feed-forward network of multi-server queues:
+- waits use the Allen-Cunneen GI/G/c approximation, the M/M/c Erlang C wait
+  scaled by (ca^2 + cs^2) / 2, with lognormal service moments from Params
+- stations with priority queues use the non-preemptive priority extension of
+  that wait, Wk = W0 / ((1 - s(k-1)) (1 - s(k))) with s(k) the utilization of
+  priorities up to k
+- arrival variability is propagated through departures, splits and merges
+  (QNA style), starting from Poisson arrivals
+- FAST patients join the fast consultation when it holds no more patients
+  than the main one. This is modelled by sending the share of them that
+  evens out the mean number of patients at both consultations. The real
+  routing spreads arrivals more evenly than a random split, so consultation
+  waits are overestimated, most at the fast consultation
+
+The estimates are steady state, ignoring the warm-up and the finite horizon
+of the simulation, so they are a screen rather than a substitute: a scenario
+costs about a millisecond and any stage at utilization >= 1 flags it as
+unstable before it runs.
+"""
+import math
+from utils import PRIORITY_LEVELS, PRIORITY_WEIGHTS
+from tracing import STAGES, TRIAGE, CONSULT_FAST, CONSULT_MAIN, LAB_FAST, LAB_MAIN, BED
+from estimators import WAIT_KPIS
+from parameters import Params
+
+# Priorities triaged to the main stream, see Patient.set_outcome
+MAIN_LEVELS = [level for level in PRIORITY_LEVELS if level < 3]
+FAST_LEVELS = [level for level in PRIORITY_LEVELS if level >= 3]
+
+def erlang_c(servers, load):
+    """
+    Returns the probability that an arrival waits in an M/M/c queue
+
+    Params:
+    -------
+    servers = number of servers c
+    load = offered load, arrival rate times mean service time, below servers
+    """
+    # Erlang B by its stable recurrence, then converted to Erlang C
+    blocking = 1.0
+    for k in range(1, servers + 1):
+        blocking = load * blocking / (k + load * blocking)
+    return blocking / (1 - load / servers * (1 - blocking))
+
+def split(scv, probability):
+    """
+    Returns the squared coefficient of variation of a flow thinned with a probability
+    """
+    return probability * scv + 1 - probability
+
+def merge(flows):
+    """
+    Returns the squared coefficient of variation of merged (rate, scv) flows
+    """
+    rate = sum(rate for rate, _ in flows)
+    return sum(rate * scv for rate, scv in flows) / rate if rate > 0 else 1.0
+
+def station(rates, servers, mean, scv_service, scv_arrival, ordered):
+    """
+    Returns the approximate steady state of a multi-server station
+
+    Params:
+    -------
+    rates = arrival rate (patients per minute) of each priority level
+    servers = number of servers
+    mean = mean service time in minutes
+    scv_service = squared coefficient of variation of the service time
+    scv_arrival = squared coefficient of variation of the interarrival time
+    ordered = whether the queue is ordered by priority, otherwise FIFO
+
+    Returns:
+    -------
+    (dict) arrival rate, servers, utilization, mean wait, mean wait of each
+    priority, stability and squared coefficient of variation of departures
+    """
+    rates = {level: rate for level, rate in rates.items() if rate > 0}
+    rate = sum(rates.values())
+    utilization = rate * mean / servers
+    result = {'arrival_rate': rate, 'servers': servers, 'utilization': utilization, 'stable': utilization < 1}
+    if rate == 0:
+        return {**result, 'wait': 0.0, 'waits': {}, 'departure_scv': 1.0}
+    if utilization >= 1:
+        # A saturated station always has a queue, so it departs patients at the pace of its services
+        return {**result, 'wait': math.inf, 'waits': {level: math.inf for level in rates},
+                'departure_scv': 1 + (scv_service - 1) / math.sqrt(servers)}
+
+    base = erlang_c(servers, rate * mean) * mean / servers * (scv_arrival + scv_service) / 2
+    if ordered:
+        waits = {}
+        served = 0.0
+        for level in sorted(rates):
+            previous = served
+            served += rates[level] * mean / servers
+            waits[level] = base / ((1 - previous) * (1 - served))
+        wait = sum(rates[level] * waits[level] for level in rates) / rate
+    else:
+        wait = base / (1 - utilization)
+        waits = {level: wait for level in rates}
+    departure_scv = (1 + (1 - utilization ** 2) * (scv_arrival - 1)
+                     + utilization ** 2 * (scv_service - 1) / math.sqrt(servers))
+    return {**result, 'wait': wait, 'waits': waits, 'departure_scv': departure_scv}
+
+def lognormal_scv(mean, stdev):
+    return (stdev / mean) ** 2
+
+def consultations(params, rates, triage, fast_share):
+    """
+    Returns the fast and main consultation stations when a fast_share of the FAST
+    patients goes to the fast consultation
+    """
+    fast_rates = {level: fast_share * rates[level] for level in FAST_LEVELS}
+    main_rates = {level: rates[level] for level in MAIN_LEVELS}
+    main_rates.update({level: (1 - fast_share) * rates[level] for level in FAST_LEVELS})
+    fast_probability = sum(fast_rates.values()) / triage['arrival_rate']
+    fast = station(fast_rates, params.number_docs_fast, params.mean_doc_consult_fast,
+                   lognormal_scv(params.mean_doc_consult_fast, params.stdev_doc_consult_fast),
+                   split(triage['departure_scv'], fast_probability), False)
+    main = station(main_rates, params.number_docs_main, params.mean_doc_consult_main,
+                   lognormal_scv(params.mean_doc_consult_main, params.stdev_doc_consult_main),
+                   split(triage['departure_scv'], 1 - fast_probability), True)
+    return fast, main
+
+def patients_at(result, mean):
+    """
+    Returns the mean number of patients at a station, waiting or in service
+    """
+    return result['arrival_rate'] * (result['wait'] + mean)
+
+def balance(params, rates, triage, iterations=40):
+    """
+    Returns the share of FAST patients sent to the fast consultation, the one
+    evening out the mean number of patients at both consultations
+    """
+    def excess(fast_share):
+        fast, main = consultations(params, rates, triage, fast_share)
+        fast_patients = patients_at(fast, params.mean_doc_consult_fast)
+        main_patients = patients_at(main, params.mean_doc_consult_main)
+        if math.isinf(fast_patients):
+            return math.inf
+        return fast_patients - main_patients
+
+    # Ties go to the fast consultation, so it takes every FAST patient while it is no busier
+    if excess(1.0) <= 0:
+        return 1.0
+    low, high = 0.0, 1.0
+    for _ in range(iterations):
+        middle = (low + high) / 2
+        if excess(middle) > 0:
+            high = middle
+        else:
+            low = middle
+    return (low + high) / 2
+
+def screen(params, peak=False):
+    """
+    Returns the analytical estimate of a scenario
+
+    Params:
+    -------
+    params = simulation parameters
+    peak = with an arrival_profile, screen the busiest hour instead of the daily average
+
+    Returns:
+    -------
+    (dict) 'stable', the share of FAST patients seen at the fast consultation,
+    the station estimates of every stage and the mean wait of every KPI over
+    the patients visiting the stage, like the Dataset columns
+    """
+    if params.arrival_profile is None:
+        arrival_rate = 1.0 / params.mean_interarrival
+    else:
+        profile = params.arrival_profile
+        arrival_rate = (max(profile) if peak else sum(profile) / len(profile)) / params.mean_interarrival
+    rates = {level: arrival_rate * weight for level, weight in zip(PRIORITY_LEVELS, PRIORITY_WEIGHTS)}
+
+    triage = station(rates, params.number_triage, params.mean_triage,
+                     lognormal_scv(params.mean_triage, params.stdev_triage), 1.0, False)
+    fast_share = balance(params, rates, triage)
+    fast, main = consultations(params, rates, triage, fast_share)
+
+    # Lab outcomes are drawn at triage, FAST patients seen at the main consultation
+    # keep the fast lab probability but queue at the main lab
+    lab_fast_rates = {level: fast_share * rates[level] * params.p_fast_lab for level in FAST_LEVELS}
+    lab_main_rates = {level: rates[level] * params.p_main_lab for level in MAIN_LEVELS}
+    lab_main_rates.update({level: (1 - fast_share) * rates[level] * params.p_fast_lab for level in FAST_LEVELS})
+    lab_main_probability = sum(lab_main_rates.values()) / main['arrival_rate'] if main['arrival_rate'] > 0 else 0.0
+    lab_fast = station(lab_fast_rates, params.number_nurses_fast, params.mean_lab_fast,
+                       lognormal_scv(params.mean_lab_fast, params.stdev_lab_fast),
+                       split(fast['departure_scv'], params.p_fast_lab), False)
+    lab_main = station(lab_main_rates, params.number_nurses_main, params.mean_lab_main,
+                       lognormal_scv(params.mean_lab_main, params.stdev_lab_main),
+                       split(main['departure_scv'], lab_main_probability), True)
+
+    # Only MAIN patients get a bed, after the main lab or straight from the main consultation
+    from_lab = {level: rates[level] * params.p_main_lab * params.p_ed for level in MAIN_LEVELS}
+    from_consult = {level: rates[level] * (1 - params.p_main_lab) * params.p_ed for level in MAIN_LEVELS}
+    bed_rates = {level: from_lab[level] + from_consult[level] for level in MAIN_LEVELS}
+    flows = []
+    if lab_main['arrival_rate'] > 0:
+        flows.append((sum(from_lab.values()),
+                      split(lab_main['departure_scv'], sum(from_lab.values()) / lab_main['arrival_rate'])))
+    if main['arrival_rate'] > 0:
+        flows.append((sum(from_consult.values()),
+                      split(main['departure_scv'], sum(from_consult.values()) / main['arrival_rate'])))
+    # Bed stays are exponential
+    bed = station(bed_rates, params.number_of_beds, params.mean_bed_time, 1.0, merge(flows), True)
+
+    stages = {TRIAGE: triage, CONSULT_FAST: fast, CONSULT_MAIN: main, LAB_FAST: lab_fast, LAB_MAIN: lab_main,
+              BED: bed}
+    kpis = {'triage_wait_time': triage['wait'],
+            'consultation_wait_time': mean_wait([fast, main]),
+            'lab_wait_time': mean_wait([lab_fast, lab_main]),
+            'bed_wait_time': bed['wait']}
+    return {'stable': all(result['stable'] for result in stages.values()), 'fast_share': fast_share,
+            'stages': {STAGES[stage]: result for stage, result in stages.items()}, 'kpis': kpis}
+
+def mean_wait(results):
+    """
+    Returns the mean wait of the patients visiting any of the given stations
+    """
+    rate = sum(result['arrival_rate'] for result in results)
+    if rate == 0:
+        return math.nan
+    return sum(result['arrival_rate'] * result['wait'] for result in results if result['arrival_rate'] > 0) / rate
+
+def screen_many(candidates, base_params=None, peak=False):
+    """
+    Returns the screen of every candidate, in candidate order
+
+    Params:
+    -------
+    candidates = list of parameter overrides, e.g. from optimizer.staffing_space
+    base_params = Params the overrides are applied on, defaults to Params()
+    peak = see screen
+    """
+    base = base_params.overrides() if base_params is not None else {}
+    return [screen(Params(**{**base, **overrides}), peak) for overrides in candidates]
+
+def shortlist(candidates, base_params=None, size=20, weights=None, peak=False):
+    """
+    Returns the stable candidates with the lowest estimated objective, best
+    first, to be simulated
+
+    Params:
+    -------
+    candidates = list of parameter overrides
+    base_params = Params the overrides are applied on, defaults to Params()
+    size = maximum number of candidates returned
+    weights = weight of each KPI in the objective, defaults to 1 for every wait
+    peak = see screen
+    """
+    weights = weights if weights is not None else {kpi: 1 for kpi in WAIT_KPIS}
+    scored = []
+    for overrides, result in zip(candidates, screen_many(candidates, base_params, peak)):
+        if result['stable']:
+            objective = sum(weight * result['kpis'][kpi] for kpi, weight in weights.items()
+                            if not math.isnan(result['kpis'][kpi]))
+            scored.append((objective, len(scored), overrides))
+    scored.sort(key=lambda item: item[:2])
+    return [overrides for _, _, overrides in scored[:size]]
+
+if __name__ == "__main__":
+    for name, overrides in {"10min": {}, "9min": {"mean_interarrival": 9},
+                            "9min_number_triage_2": {"mean_interarrival": 9, "number_triage": 2}}.items():
+        result = screen(Params(**overrides))
+        print(f"{name}: stable={result['stable']} fast_share={result['fast_share']:.2f}")
+        for stage, estimate in result['stages'].items():
+            print(f"  {stage}: utilization {estimate['utilization']:.2f}, wait {estimate['wait']:.1f} min")
@@ -0,0 +1,148 @@
+import hashlib
+import itertools
+import json
+import os
+import numpy as np
+from parameters import Params
+from dataset import Dataset
+from main import map_replications, run_replication
+from utils import replication_seed
+from writers import open_writer
+from estimators import WAIT_KPIS, StreamingSummary
+
+# Bump whenever a model change invalidates previously cached replications
+CACHE_VERSION = 3
+# Parameters that do not change the outcome of a single replication
+UNKEYED = {'number_of_runs', 'engine'}
+
+def grid(**axes):
+    """
+    Returns the override dicts of every combination of the given parameter values
+
+    Params:
+    -------
+    axes = parameter name mapped to the list of values to sweep,
+           e.g. grid(mean_interarrival=[9, 10], number_triage=[1, 2])
+    """
+    names = list(axes)
+    return [dict(zip(names, values)) for values in itertools.product(*axes.values())]
+
+def scenario_name(overrides):
+    """
+    Returns a readable scenario name built from its overrides
+    """
+    if not overrides:
+        return 'baseline'
+    return '_'.join(f"{name}={value}" for name, value in sorted(overrides.items()))
+
+def replication_key(params, run):
+    """
+    Returns the cache key of one replication, a hash of the parameters that
+    affect it and of the seed of the run
+    """
+    values = {name: value for name, value in params.as_dict().items() if name not in UNKEYED}
+    payload = json.dumps({'version': CACHE_VERSION, 'params': values,
+                          'seed': replication_seed(params.random_seed, run)}, sort_keys=True)
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+class ReplicationCache:
+    """
+    Finished replications stored on disk as one .npz file of columns per key
+    """
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, key):
+        return os.path.join(self.directory, f"{key}.npz")
+
+    def contains(self, params, run):
+        return os.path.exists(self.path(replication_key(params, run)))
+
+    def get(self, params, run):
+        """
+        Returns the cached Dataset of the replication, or None if it was never run
+        """
+        path = self.path(replication_key(params, run))
+        if not os.path.exists(path):
+            return None
+        with np.load(path) as columns:
+            dataset = Dataset.from_columns(params, run, columns)
+            dataset.resources = json.loads(str(columns['resources']))
+            dataset.series = [tuple(row) for row in json.loads(str(columns['series']))]
+            dataset.controls = json.loads(str(columns['controls']))
+        return dataset
+
+    def put(self, params, run, dataset):
+        # Write to a temporary file first so an interrupted sweep never leaves a partial entry
+        path = self.path(replication_key(params, run))
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'wb') as file:
+            np.savez(file, resources=json.dumps(dataset.resources), series=json.dumps(dataset.series),
+                     controls=json.dumps(dataset.controls),
+                     **{name: column[:dataset.size] for name, column in dataset.columns.items()})
+        os.replace(tmp_path, path)
+
+def run_sweep(scenarios, workers=1, cache_dir='data/cache', base_params=None, output='csv', kpis=WAIT_KPIS,
+              controls=(), collect=False, directory='data'):
+    """
+    Runs every replication of every scenario over one worker pool, reusing
+    replications found in the cache. Runs are written and summarised in run
+    order as they arrive, so memory does not hold the whole sweep
+
+    Params:
+    -------
+    scenarios = dict of scenario name to Params overrides, or a list of
+                overrides (e.g. from grid) named with scenario_name
+    workers = number of worker processes
+    cache_dir = directory of the replication cache, None disables caching
+    base_params = Params the overrides are applied on, defaults to Params()
+    output = output format of every scenario, see writers.open_writer, None to skip writing
+    kpis = Dataset columns summarised, see estimators.StreamingSummary
+    controls = control variates of the summaries, e.g. estimators.KPI_CONTROLS
+    collect = also keep the Dataset of all the runs of every scenario
+    directory = output directory of the scenarios
+
+    Returns:
+    -------
+    (dict) scenario name to the StreamingSummary of its runs, which estimators.compare
+    accepts, and with collect a second dict of scenario name to the Dataset of its runs
+    """
+    if not isinstance(scenarios, dict):
+        scenarios = {scenario_name(overrides): overrides for overrides in scenarios}
+    base = base_params.overrides() if base_params is not None else {}
+    cache = ReplicationCache(cache_dir) if cache_dir is not None else None
+
+    # Every run in scenario and run order, the ones missing from the cache are simulated
+    plan = []
+    for name, overrides in scenarios.items():
+        params = Params(**{**base, **overrides})
+        for run in range(params.number_of_runs):
+            plan.append((name, params, run, cache is not None and cache.contains(params, run)))
+    results = map_replications(((params, run) for name, params, run, cached in plan if not cached), workers)
+
+    summaries = {}
+    datasets = {}
+    writer = None
+    for name, params, run, cached in plan:
+        dataset = cache.get(params, run) if cached else None
+        if dataset is None:
+            # Runs removed from the cache since the sweep started are simulated here
+            dataset = next(results) if not cached else run_replication(params, run)
+            if cache is not None:
+                cache.put(params, run, dataset)
+        if name not in summaries:
+            if writer is not None:
+                writer.close()
+            writer = open_writer(output, name, directory) if output is not None else None
+            summaries[name] = StreamingSummary(kpis, controls=controls)
+            if collect:
+                datasets[name] = Dataset(params)
+        if writer is not None:
+            writer.write(dataset)
+        summaries[name].update(dataset)
+        if collect:
+            datasets[name].extend(dataset)
+    if writer is not None:
+        writer.close()
+    return (summaries, datasets) if collect else summaries
@@ -0,0 +1,146 @@
+import json
+import os
+import struct
+import numpy as np
+
+"""
+Trace levels, a tracer records every event at or below its level
+"""
+OFF = 0
+SERVICE = 1  # start and finish of service, patient leaving the ED
+QUEUE = 2  # additionally every patient joining a queue
+
+"""
+Stage and event codes stored in the trace records
+"""
+STAGES = ['triage', 'consult_fast', 'consult_main', 'lab_fast', 'lab_main', 'bed']
+TRIAGE, CONSULT_FAST, CONSULT_MAIN, LAB_FAST, LAB_MAIN, BED = range(len(STAGES))
+EVENTS = ['queued', 'start', 'finish', 'exit']
+QUEUED, START, FINISH, EXIT = range(len(EVENTS))
+
+# time, run, p_id, stage, event, queue length, busy servers
+BINARY_RECORD = struct.Struct('<dIIBBHH')
+BINARY_DTYPE = np.dtype([('time', '<f8'), ('run', '<u4'), ('p_id', '<u4'), ('stage', 'u1'),
+                         ('event', 'u1'), ('queue', '<u2'), ('busy', '<u2')])
+
+class JsonlSink:
+    """
+    Buffered sink writing one JSON object per event
+    """
+    extension = 'jsonl'
+
+    def __init__(self, path, buffer_size=4096):
+        """
+        Params:
+        -------
+        path = file the events are written to
+        buffer_size = number of events kept in memory between writes
+        """
+        self.file = open(path, 'w')
+        self.buffer = []
+        self.buffer_size = buffer_size
+
+    def write(self, time, run, p_id, stage, event, queue, busy):
+        self.buffer.append(json.dumps({'time': time, 'run': run, 'p_id': p_id, 'stage': STAGES[stage],
+                                       'event': EVENTS[event], 'queue': queue, 'busy': busy}))
+        if len(self.buffer) >= self.buffer_size:
+            self.flush()
+
+    def flush(self):
+        if self.buffer:
+            self.file.write('\n'.join(self.buffer) + '\n')
+            self.buffer = []
+
+    def close(self):
+        self.flush()
+        self.file.close()
+
+class BinarySink(JsonlSink):
+    """
+    Buffered sink writing fixed size binary records, see read_trace
+    """
+    extension = 'bin'
+
+    def __init__(self, path, buffer_size=4096):
+        self.file = open(path, 'wb')
+        self.buffer = []
+        self.buffer_size = buffer_size
+
+    def write(self, time, run, p_id, stage, event, queue, busy):
+        self.buffer.append(BINARY_RECORD.pack(time, run, p_id, stage, event, queue, busy))
+        if len(self.buffer) >= self.buffer_size:
+            self.flush()
+
+    def flush(self):
+        if self.buffer:
+            self.file.write(b''.join(self.buffer))
+            self.buffer = []
+
+SINKS = {'jsonl': JsonlSink, 'binary': BinarySink}
+
+class Tracer:
+    """
+    Records the events of one replication to a sink
+    """
+    def __init__(self, sink, run, level=SERVICE):
+        self.sink = sink
+        self.run = run
+        self.level = level
+
+    def record(self, level, time, p_id, stage, event, queue, busy):
+        """
+        Record an event if the tracer level allows it
+
+        Params:
+        -------
+        level = trace level of the event
+        time = simulation time of the event
+        p_id = id of the patient
+        stage = stage code, e.g. TRIAGE
+        event = event code, e.g. START
+        queue = number of patients waiting at the stage
+        busy = number of busy servers at the stage
+        """
+        if level <= self.level:
+            self.sink.write(time, self.run, p_id, stage, event, queue, busy)
+
+    def close(self):
+        self.sink.close()
+
+class TraceConfig:
+    """
+    Picklable description of where and how to trace, so every worker process
+    can open its own tracer for the runs it executes
+    """
+    def __init__(self, directory, level=SERVICE, fmt='jsonl', buffer_size=4096):
+        """
+        Params:
+        -------
+        directory = directory receiving one trace file per run
+        level = trace level, OFF disables tracing
+        fmt = 'jsonl' or 'binary'
+        buffer_size = number of events kept in memory between writes
+        """
+        if fmt not in SINKS:
+            raise ValueError(f"Unknown trace format {fmt}, expected one of {list(SINKS)}")
+        self.directory = directory
+        self.level = level
+        self.fmt = fmt
+        self.buffer_size = buffer_size
+
+    def open(self, run):
+        """
+        Returns a Tracer for the run, or None if tracing is off
+        """
+        if self.level <= OFF:
+            return None
+        sink_class = SINKS[self.fmt]
+        os.makedirs(self.directory, exist_ok=True)
+        path = os.path.join(self.directory, f"run_{run}.{sink_class.extension}")
+        return Tracer(sink_class(path, self.buffer_size), run, self.level)
+
+def read_trace(path):
+    """
+    Load a binary trace file as a numpy structured array
+    """
+    return np.fromfile(path, dtype=BINARY_DTYPE)
@@ -1,6 +1,47 @@
 import numpy as np
 import math
 
+# Triage priority mix of arriving patients, see entities.Priority
+PRIORITY_LEVELS = [1, 2, 3, 4, 5]
+PRIORITY_WEIGHTS = [0.1, 0.2, 0.4, 0.2, 0.1]
+# Service time streams whose means are control variates, see RandomStreams.controls
+CONTROL_STREAMS = ['triage', 'consult_fast', 'consult_main', 'lab_fast', 'lab_main', 'bed']
+
+def replication_seed(base_seed, run, purpose=0):
+    '''
+    Returns a deterministic seed for one replication, derived from the
+    scenario seed and the run id so every run gets an independent stream
+
+    Params:
+    -------
+    base_seed = seed of the scenario
+    run = run id of the replication
+    purpose = non zero values give streams independent of the replications,
+              e.g. for warm-up snapshots
+
+    Returns:
+    -------
+    (int)
+    '''
+    entropy = [base_seed, run] if purpose == 0 else [base_seed, run, purpose]
+    return int(np.random.SeedSequence(entropy).generate_state(1)[0])
+
+def replication_streams(params, run, block_size=1024):
+    '''
+    Returns the RandomStreams of one replication. With Params.antithetic, runs
+    2k and 2k+1 share the seed of run 2k and run 2k+1 mirrors its variates
+
+    Params:
+    -------
+    params = simulation parameters
+    run = run id of the replication
+    block_size = variates drawn per refill of every stream, see RandomStreams
+    '''
+    if not params.antithetic:
+        return RandomStreams(params, replication_seed(params.random_seed, run), block_size=block_size)
+    return RandomStreams(params, replication_seed(params.random_seed, run - run % 2), mirror=run % 2 == 1,
+                         block_size=block_size)
+
 class Lognormal:
     """
     Encapsulates a lognormal distirbution
@@ -44,6 +85,188 @@ class Lognormal:
         """
         return self.rand.lognormal(self.mu, self.sigma)
     
+class VariateStream:
+    """
+    Hands out variates one at a time from blocks drawn in bulk from a
+    numpy generator, refilling lazily when a block runs out
+    """
+    def __init__(self, rng, block_size=1024):
+        """
+        Params:
+        -------
+        rng = numpy random generator owned by this stream
+        block_size = number of variates drawn per refill
+        """
+        self.rand = rng
+        self.block_size = block_size
+        self.block = []
+        self.index = 0
+        # Count and sum of the variates of the blocks used up, see drawn
+        self.count = 0
+        self.total = 0.0
+
+    def draw(self, size):
+        """
+        Draw a block of variates, implemented by each distribution
+        """
+        raise NotImplementedError
+
+    def sample(self):
+        """
+        Return the next variate of the stream
+        """
+        if self.index == len(self.block):
+            self.count += len(self.block)
+            self.total += sum(self.block)
+            # tolist() converts once per block so every sample is a plain python value
+            self.block = self.draw(self.block_size).tolist()
+            self.index = 0
+        value = self.block[self.index]
+        self.index += 1
+        return value
+
+    def drawn(self):
+        """
+        Returns the number and the sum of the variates handed out so far
+        """
+        return self.count + self.index, self.total + sum(self.block[:self.index])
+
+class LognormalStream(VariateStream, Lognormal):
+    """
+    Stream of lognormal variates with a given mean and standard deviation
+    """
+    def __init__(self, mean, stdev, rng, block_size=1024):
+        VariateStream.__init__(self, rng, block_size)
+        self.mean = mean
+        self.mu, self.sigma = self.normal_moments_from_lognormal(mean, stdev**2)
+
+    def draw(self, size):
+        return self.rand.lognormal(self.mu, self.sigma, size)
+
+class ExponentialStream(VariateStream):
+    """
+    Stream of exponential variates with a given mean
+    """
+    def __init__(self, mean, rng, block_size=1024):
+        super().__init__(rng, block_size)
+        self.mean = mean
+
+    def draw(self, size):
+        return self.rand.exponential(self.mean, size)
+
+class ChoiceStream(VariateStream):
+    """
+    Stream of values drawn from a discrete distribution
+    """
+    def __init__(self, values, weights, rng, block_size=1024):
+        super().__init__(rng, block_size)
+        self.values = np.asarray(values)
+        self.p = np.asarray(weights, dtype=float) / sum(weights)
+
+    def draw(self, size):
+        return self.values[self.rand.choice(len(self.values), size, p=self.p)]
+
+class AntitheticGenerator:
+    """
+    Numpy generator drawing the variates used by the streams by inversion of
+    uniforms and from standard normals, so that a mirrored generator sharing
+    the seed draws the antithetic variates: u -> 1 - u and z -> -z
+    """
+    def __init__(self, rng, mirror=False):
+        """
+        Params:
+        -------
+        rng = numpy random generator
+        mirror = draw the antithetic variates of an unmirrored generator with the same seed
+        """
+        self.rng = rng
+        self.mirror = mirror
+
+    def random(self, size=None):
+        u = self.rng.random(size)
+        return 1.0 - u if self.mirror else u
+
+    def standard_normal(self, size=None):
+        z = self.rng.standard_normal(size)
+        return -z if self.mirror else z
+
+    def exponential(self, scale=1.0, size=None):
+        return -scale * np.log1p(-self.random(size))
+
+    def lognormal(self, mean=0.0, sigma=1.0, size=None):
+        return np.exp(mean + sigma * self.standard_normal(size))
+
+    def choice(self, a, size=None, p=None):
+        # Inverse of the cumulative distribution, like Generator.choice
+        cdf = np.cumsum(p)
+        cdf /= cdf[-1]
+        return np.searchsorted(cdf, self.random(size), side='right')
+
+class RandomStreams:
+    """
+    Independent random streams of one replication, one per stage and purpose
+    """
+    def __init__(self, params, seed, mirror=None, block_size=1024):
+        """
+        Params:
+        -------
+        params = simulation parameters of the run
+        seed = seed of the run, see replication_seed
+        mirror = None draws with the numpy samplers. Otherwise the run is half of an
+                 antithetic pair drawing through AntitheticGenerator, True mirroring
+                 the variates of the run with the same seed, see replication_streams
+        block_size = variates drawn per refill of every stream, smaller blocks suit short
+                     runs and draw the same variates
+        """
+        rngs = [np.random.default_rng(s) for s in np.random.SeedSequence(seed).spawn(12)]
+        if mirror is not None:
+            rngs = [AntitheticGenerator(rng, mirror) for rng in rngs]
+        rngs = iter(rngs)
+        # Generators of the bulk arrival schedule, see arrivals.arrival_schedule
+        self.arrivals = next(rngs)
+        self.triage = LognormalStream(params.mean_triage, params.stdev_triage, next(rngs), block_size)
+        self.consult_fast = LognormalStream(params.mean_doc_consult_fast, params.stdev_doc_consult_fast, next(rngs), block_size)
+        self.consult_main = LognormalStream(params.mean_doc_consult_main, params.stdev_doc_consult_main, next(rngs), block_size)
+        self.lab_fast = LognormalStream(params.mean_lab_fast, params.stdev_lab_fast, next(rngs), block_size)
+        self.lab_main = LognormalStream(params.mean_lab_main, params.stdev_lab_main, next(rngs), block_size)
+        self.bed = ExponentialStream(params.mean_bed_time, next(rngs), block_size)
+        self.priority = ChoiceStream(PRIORITY_LEVELS, PRIORITY_WEIGHTS, next(rngs), block_size)
+        # Lab outcomes are entities.LabOutcome codes, 1 = lab and 0 = no lab
+        self.fast_lab_outcome = ChoiceStream([1, 0], [params.p_fast_lab, 1-params.p_fast_lab], next(rngs), block_size)
+        self.main_lab_outcome = ChoiceStream([1, 0], [params.p_main_lab, 1-params.p_main_lab], next(rngs), block_size)
+        self.bed_outcome = ChoiceStream([True, False], [params.p_ed, 1-params.p_ed], next(rngs), block_size)
+        self.thinning = next(rngs)
+        # Service time streams indexed by stage code, see tracing.STAGES
+        self.services = [self.triage, self.consult_fast, self.consult_main, self.lab_fast, self.lab_main, self.bed]
+        # Draw the service demands of every patient on arrival, see Params.common_random_numbers
+        self.demands = params.common_random_numbers
+
+    def service_time(self, stage, patient):
+        """
+        Returns the service time of a patient starting service at a stage
+        """
+        if patient.demands is not None:
+            return patient.demands[stage]
+        return self.services[stage].sample()
+
+    def controls(self, expected_arrivals):
+        """
+        Returns the control variates of the run: the relative deviation of the
+        number of arrivals and of the mean service time of every stage from
+        their expected values, each with a known mean of zero
+
+        Params:
+        -------
+        expected_arrivals = expected number of arrivals of the run, see arrivals.expected_arrivals
+        """
+        # Every arrival draws a priority and nothing else does
+        arrivals, _ = self.priority.drawn()
+        controls = {'arrivals': arrivals / expected_arrivals - 1 if expected_arrivals > 0 else 0.0}
+        for name in CONTROL_STREAMS:
+            count, total = getattr(self, name).drawn()
+            controls[name] = total / count / getattr(self, name).mean - 1 if count else 0.0
+        return controls
+
 #NOT USED, FOR REFERENCE ONLY
 class DiscreteNormal:
     """
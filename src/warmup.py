@@ -0,0 +1,180 @@
+"""
+Warm-up handling: snapshots of a warmed-up ED that replications start from,
+and MSER detection of the warm-up length.
+
+A snapshot holds every patient in the ED at the end of the warm-up, with the
+residual service time of those in service. Replications started from a
+snapshot skip simulating the transient; only patients leaving the ED after
+the snapshot are recorded. Staffing of the replications may differ from the
+snapshot's, which suits variants that only change downstream staffing.
+"""
+import math
+import numpy as np
+import simpy
+from entities import Patient
+from dataset import Dataset
+from main import EmergencyDepartment, patient_generator, run_replication, map_replications
+from utils import RandomStreams, replication_seed
+from tracing import STAGES
+
+# Purpose code of the random streams used to warm up snapshots, see replication_seed
+WARM_UP_STREAMS = 1
+# Patient fields carried by a snapshot
+PATIENT_FIELDS = [name for name in Patient.__slots__ if name != 'params']
+
+class Snapshot:
+    """
+    State of the ED at a point in time
+    """
+    def __init__(self, time, next_p_id, stages):
+        """
+        Params:
+        -------
+        time = simulation time of the snapshot
+        next_p_id = id of the next arriving patient
+        stages = stage code mapped to (in_service, waiting), in_service being a list of
+                 (patient fields, residual service time, service start) and waiting a list
+                 of patient fields in queue order
+        """
+        self.time = time
+        self.next_p_id = next_p_id
+        self.stages = stages
+
+    def patients(self):
+        return sum(len(in_service) + len(waiting) for in_service, waiting in self.stages.values())
+
+    def restore(self, ed, params):
+        """
+        Put the patients of the snapshot back into a freshly built EmergencyDepartment
+        or kernel.Kernel
+        """
+        for stage, (in_service, waiting) in self.stages.items():
+            # Patients in service first so they take the servers before the queue
+            for fields, residual, service_start in in_service:
+                ed.resume_patient(stage, make_patient(fields, params), residual, service_start)
+            for fields in waiting:
+                ed.resume_patient(stage, make_patient(fields, params))
+
+    def __repr__(self):
+        counts = ', '.join(f"{STAGES[stage]}={len(s[0])}+{len(s[1])}" for stage, s in self.stages.items())
+        return f"Snapshot(time={self.time}, {counts})"
+
+def make_patient(fields, params):
+    patient = Patient(fields['p_id'], fields['arrival_time'], params)
+    for name, value in fields.items():
+        setattr(patient, name, value)
+    return patient
+
+def capture_snapshot(params, index):
+    """
+    Simulates the warm-up of params and returns the state of the ED at its end
+
+    Params:
+    -------
+    params = simulation parameters, Params.warm_up is the snapshot time
+    index = snapshot id, seeds streams independent of the replications
+    """
+    params = params.frozen()
+    streams = RandomStreams(params, replication_seed(params.random_seed, index, WARM_UP_STREAMS))
+    env = simpy.Environment()
+    dataset = Dataset(params, index)
+    ed = EmergencyDepartment(env, params, dataset, streams)
+    env.process(patient_generator(env, params, ed.triage, streams))
+    env.run(until=params.warm_up)
+
+    stages = {}
+    for stage, resource in ed.resources.items():
+        in_service = []
+        waiting = []
+        for request in resource.users:
+            fields = {name: getattr(request.patient, name) for name in PATIENT_FIELDS}
+            if hasattr(request, 'service_end'):
+                in_service.append((fields, request.service_end - env.now, request.usage_since))
+            else:
+                # Granted at this very instant, its service has not been drawn yet
+                waiting.append(fields)
+        for request in resource.put_queue:
+            waiting.append({name: getattr(request.patient, name) for name in PATIENT_FIELDS})
+        stages[stage] = (in_service, waiting)
+
+    # Every patient that arrived has either left or is somewhere in the ED
+    in_system = sum(len(in_service) + len(waiting) for in_service, waiting in stages.values())
+    return Snapshot(env.now, dataset.size + in_system + 1, stages)
+
+def snapshot_pool(params, count, workers=1):
+    """
+    Returns count independent snapshots of params at the end of its warm-up
+    """
+    if workers <= 1:
+        return [capture_snapshot(params, index) for index in range(count)]
+    from concurrent.futures import ProcessPoolExecutor
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(capture_snapshot, [params] * count, range(count)))
+
+class SnapshotReplication:
+    """
+    Picklable replicate function starting run r from snapshot r modulo the pool
+    size, to pass as run_simulator(..., replicate=SnapshotReplication(pool))
+    """
+    def __init__(self, snapshots):
+        self.snapshots = snapshots
+
+    def __call__(self, params, run, trace=None):
+        return run_replication(params, run, trace, snapshot=self.snapshots[run % len(self.snapshots)])
+
+def mser(series, batch_size=5):
+    """
+    Returns the MSER truncation point of a series: the number of leading values
+    to delete that minimises the standard error of the remaining mean.
+    Only the first half of the series is considered.
+
+    Params:
+    -------
+    series = output series in time order, e.g. mean waits per time bin
+    batch_size = values averaged per batch before truncating (5 gives MSER-5)
+    """
+    series = np.asarray(series, dtype=float)
+    batches = len(series) // batch_size
+    if batches < 2:
+        return 0
+    means = series[:batches * batch_size].reshape(batches, batch_size).mean(axis=1)
+    best, best_stat = 0, math.inf
+    for d in range(batches // 2):
+        remaining = means[d:]
+        stat = ((remaining - remaining.mean()) ** 2).sum() / len(remaining) ** 2
+        if stat < best_stat:
+            best, best_stat = d, stat
+    return best * batch_size
+
+def detect_warm_up(params, runs=20, bin_width=10, batch_size=5, workers=1):
+    """
+    Returns a warm-up length in minutes detected with MSER on pilot runs.
+
+    The pilot runs simulate the whole horizon (warm_up + sim_duration) from an
+    empty ED. The total wait of every patient is averaged by arrival time bin
+    across runs, and MSER picks where that series stops trending.
+
+    Params:
+    -------
+    params = simulation parameters
+    runs = number of pilot replications
+    bin_width = width of the arrival time bins in minutes
+    batch_size = MSER batch size, in bins
+    workers = number of worker processes
+    """
+    horizon = params.warm_up + params.sim_duration
+    pilot = type(params)(**{**params.overrides(), 'warm_up': 0, 'sim_duration': horizon})
+    bins = int(math.ceil(horizon / bin_width))
+    totals = np.zeros(bins)
+    counts = np.zeros(bins)
+    waits = ['triage_wait_time', 'consultation_wait_time', 'lab_wait_time', 'bed_wait_time']
+    for dataset in map_replications(((pilot, run) for run in range(runs)), workers):
+        columns = {name: column[:dataset.size] for name, column in dataset.columns.items()}
+        total_wait = np.nansum([columns[name] for name in waits], axis=0)
+        index = np.minimum((columns['arrival_time'] // bin_width).astype(np.int64), bins - 1)
+        totals += np.bincount(index, weights=total_wait, minlength=bins)
+        counts += np.bincount(index, minlength=bins)
+    observed = np.flatnonzero(counts)
+    series = totals[observed] / counts[observed]
+    truncation = mser(series, batch_size)
+    return float(observed[truncation] * bin_width) if truncation < len(observed) else 0.0
@@ -0,0 +1,179 @@
+import os
+import shutil
+import numpy as np
+from dataset import CATEGORIES
+
+class CsvWriter:
+    """
+    Appends every run to one CSV file, matching the historical output format.
+    Resource statistics and time series go to <name>_resources.csv and
+    <name>_series.csv next to it.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.started = set()
+
+    def append(self, df, path):
+        df.to_csv(path, mode='a' if path in self.started else 'w', header=path not in self.started, index=False)
+        self.started.add(path)
+
+    def write(self, dataset):
+        """
+        Append the records of a dataset, e.g. a finished run
+        """
+        base = self.path[:-len('.csv')] if self.path.endswith('.csv') else self.path
+        self.append(dataset.get_patients_df(), self.path)
+        if dataset.resources:
+            self.append(dataset.get_resources_df(), f"{base}_resources.csv")
+        if dataset.series:
+            self.append(dataset.get_series_df(), f"{base}_series.csv")
+
+    def close(self):
+        pass
+
+class ArrowWriter:
+    """
+    Writes every run as its own compressed columnar files, partitioned as
+    <directory>/run_<run>/part_<n>.<extension>. Outcomes are dictionary
+    encoded and timings are stored as float32. Resource statistics and time
+    series are written as resources_<n> and series_<n> files of the run.
+    """
+    extension = None
+
+    def __init__(self, directory, compression='zstd'):
+        """
+        Params:
+        -------
+        directory = output directory of the scenario
+        compression = compression codec of the files
+        """
+        try:
+            import pyarrow
+        except ImportError:
+            raise ImportError(f"{type(self).__name__} requires pyarrow, install it with `pip install pyarrow`")
+        self.pa = pyarrow
+        self.directory = directory
+        self.compression = compression
+        self.parts = {}
+
+    def table(self, dataset):
+        """
+        Returns the records of a dataset as an arrow table
+        """
+        pa = self.pa
+        data = {}
+        for name, column in dataset.columns.items():
+            column = column[:dataset.size]
+            if name in CATEGORIES:
+                data[name] = pa.DictionaryArray.from_arrays(column, CATEGORIES[name])
+            elif column.dtype == np.float64:
+                data[name] = column.astype(np.float32)
+            else:
+                data[name] = column
+        return pa.table(data)
+
+    def write(self, dataset):
+        """
+        Write the records of a dataset, e.g. a finished run, as a new part of its run partition.
+        The first part of a run replaces whatever an earlier run with the same number left there
+        """
+        part = self.parts.get(dataset.run, 0)
+        self.parts[dataset.run] = part + 1
+        directory = os.path.join(self.directory, f"run_{dataset.run:05d}")
+        if part == 0 and os.path.isdir(directory):
+            shutil.rmtree(directory)
+        os.makedirs(directory, exist_ok=True)
+        self.write_table(self.table(dataset), os.path.join(directory, f"part_{part:05d}.{self.extension}"))
+        if dataset.resources:
+            self.write_table(self.pa.Table.from_pylist(dataset.resources),
+                             os.path.join(directory, f"resources_{part:05d}.{self.extension}"))
+        if dataset.series:
+            series = dict(zip(['run', 'stage', 'time', 'busy', 'queue'], map(list, zip(*dataset.series))))
+            self.write_table(self.pa.table(series), os.path.join(directory, f"series_{part:05d}.{self.extension}"))
+
+    def write_table(self, table, path):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+class ParquetWriter(ArrowWriter):
+    extension = 'parquet'
+
+    def write_table(self, table, path):
+        import pyarrow.parquet as pq
+        pq.write_table(table, path, compression=self.compression)
+
+class FeatherWriter(ArrowWriter):
+    """
+    Arrow IPC (Feather v2) files, the fastest to reload
+    """
+    extension = 'arrow'
+
+    def write_table(self, table, path):
+        import pyarrow.feather as feather
+        feather.write_feather(table, path, compression=self.compression)
+
+WRITERS = {'csv': CsvWriter, 'parquet': ParquetWriter, 'feather': FeatherWriter}
+
+def remove_output(name, directory='data', runs=None):
+    """
+    Delete the output of a scenario, in any format
+
+    Params:
+    -------
+    name = name of the scenario
+    directory = output directory
+    runs = run numbers whose partitions are deleted, None deletes the whole output
+    """
+    path = os.path.join(directory, name)
+    if runs is not None:
+        for run in runs:
+            shutil.rmtree(os.path.join(path, f"run_{run:05d}"), ignore_errors=True)
+        return
+    shutil.rmtree(path, ignore_errors=True)
+    for suffix in ('', '_resources', '_series'):
+        if os.path.exists(f"{path}{suffix}.csv"):
+            os.remove(f"{path}{suffix}.csv")
+
+def open_writer(fmt, name, directory='data', clear=True):
+    """
+    Returns the writer of a scenario's output
+
+    Params:
+    -------
+    fmt = 'csv' (data/<name>.csv), 'parquet' or 'feather' (partitioned under data/<name>/)
+    name = name of the scenario
+    directory = output directory
+    clear = delete the earlier output of the scenario first, so it is not read back with the new
+            runs. Writers of single runs keep it, their run partition is replaced on first write
+    """
+    if fmt not in WRITERS:
+        raise ValueError(f"Unknown output format {fmt}, expected one of {list(WRITERS)}")
+    if clear:
+        remove_output(name, directory)
+    os.makedirs(directory, exist_ok=True)
+    if fmt == 'csv':
+        return CsvWriter(os.path.join(directory, f"{name}.csv"))
+    return WRITERS[fmt](os.path.join(directory, name))
+
+def read_output(name, directory='data', table='patients'):
+    """
+    Load the output of a scenario as a DataFrame, whatever its format
+
+    Params:
+    -------
+    name = name of the scenario
+    directory = output directory
+    table = 'patients', 'resources' or 'series'
+    """
+    import pandas as pd
+    path = os.path.join(directory, name)
+    csv_path = f"{path}.csv" if table == 'patients' else f"{path}_{table}.csv"
+    if os.path.exists(csv_path):
+        return pd.read_csv(csv_path)
+    import pyarrow.dataset as ds
+    prefix = 'part_' if table == 'patients' else f"{table}_"
+    files = sorted(os.path.join(root, file) for root, _, names in os.walk(path) for file in names if file.startswith(prefix))
+    fmt = 'parquet' if files and files[0].endswith('.parquet') else 'ipc'
+    return ds.dataset(files, format=fmt).to_table().to_pandas()